@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+'''Samples and sketches for approximate answers to exploratory queries
+
+Samples are drawn in a single pass over (tuple, multiplicity) pairs, and
+treat a tuple with multiplicity n as n separate elements:
+
+  bernoulli - keeps each element independently with a fixed probability
+  reservoir - keeps a uniform random sample of a fixed number of elements
+
+Both skip ahead by random gaps rather than drawing a random number for
+every element, so sampling a small fraction of a large input is cheap.
+
+HyperLogLog estimates the number of distinct tuples in a relation using a
+fixed number of small registers.
+'''
+
+import collections
+import math
+import random
+
+MASK64 = (1 << 64) - 1
+
+def _uniform(rng):
+    '''Return a random number in the open interval (0, 1)'''
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+def _gap(rng, log_q):
+    '''Return the number of elements skipped before the next one is kept
+
+    log_q is the log of the probability that an element is not kept.
+    '''
+    return int(math.log(_uniform(rng)) / log_q)
+
+def bernoulli(pairs, fraction, rng=random):
+    '''Yield pairs keeping each element with probability fraction'''
+    if fraction <= 0:
+        return
+    if fraction >= 1:
+        for pair in pairs:
+            yield pair
+        return
+
+    log_q = math.log(1.0 - fraction)
+
+    # Number of elements to skip before the next one is kept
+    skip = _gap(rng, log_q)
+    for tpl, count in pairs:
+        if skip >= count:
+            skip -= count
+            continue
+        kept = 0
+        while skip < count:
+            kept += 1
+            skip += 1 + _gap(rng, log_q)
+        skip -= count
+        yield tpl, kept
+
+def reservoir(pairs, size, rng=random):
+    '''Return a bag holding a uniform sample of size elements
+
+    This is Li's algorithm L, which skips over elements that would not
+    enter the reservoir.
+    '''
+    if size <= 0:
+        return collections.Counter()
+    sample = []
+
+    w = math.exp(math.log(_uniform(rng)) / size)
+    position = 0       # Index of the first element of the current pair
+    following = None   # Index of the next element to enter the reservoir
+    for tpl, count in pairs:
+        end = position + count
+        while len(sample) < size and position < end:
+            sample.append(tpl)
+            position += 1
+        if len(sample) < size:
+            continue
+        if following is None:
+            following = position + _gap(rng, math.log(1.0 - w))
+        while following < end:
+            sample[rng.randrange(size)] = tpl
+            w *= math.exp(math.log(_uniform(rng)) / size)
+            following += 1 + _gap(rng, math.log(1.0 - w))
+        position = end
+    return collections.Counter(sample)
+
+def _mix(h):
+    '''Scramble the bits of a 64-bit hash'''
+    h &= MASK64
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK64
+    h ^= h >> 33
+    return h
+
+class HyperLogLog:
+    '''A sketch of the distinct values in a stream
+
+    With 2**precision registers the relative standard error of an estimate
+    is 1.04 / sqrt(2**precision): 1.6% for the default precision of 12.
+    '''
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        h = _mix(hash(value))
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & MASK64
+        rank = 64 - rest.bit_length() + 1
+        rank = min(rank, 64 - self.precision + 1)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        '''Add the values seen by another sketch of the same precision'''
+        assert self.precision == other.precision
+        self.registers = bytearray(max(x, y) for x, y in
+                                   zip(self.registers, other.registers))
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        # Use linear counting while many registers are still empty
+        zeros = self.registers.count('\x00')
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(float(m) / zeros)
+        return raw
+
+    def standard_error(self):
+        '''Return the relative standard error of estimates'''
+        return 1.04 / math.sqrt(self.m)
+
+    def bounds(self, z=2.0):
+        '''Return (estimate, low, high); z standard errors wide'''
+        estimate = self.estimate()
+        error = z * self.standard_error() * estimate
+        return (int(round(estimate)), int(max(0, estimate - error)),
+                int(math.ceil(estimate + error)))
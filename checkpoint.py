@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+'''Checkpoints of the state of DO/WHILE loops
+
+A checkpoint records the relations bound to the symbols a loop assigns, and
+the number of iterations the loop has run, so that a program interrupted in
+a long-running loop can resume from its latest checkpoint.
+
+A checkpoint file holds a marshalled header followed by each relation in
+the format written by CompressedRelation.dump.  Checkpoints are written to a
+temporary file and renamed into place, so a crash while writing one leaves
+the previous checkpoint intact.
+'''
+
+import encoding
+import relation
+
+import marshal
+import os
+
+FORMAT = 'MYRCK1'
+
+# Default number of loop iterations between checkpoints
+DEFAULT_INTERVAL = 10
+
+class CheckpointException(Exception):
+    pass
+
+class Checkpoint:
+    def __init__(self, fingerprint, iteration, done, relations):
+        # Identifies the loop and its inputs; a checkpoint is only resumed
+        # by the same loop reading the same relations
+        self.fingerprint = fingerprint
+        self.iteration = iteration
+
+        # Whether the loop had terminated when the checkpoint was written
+        self.done = done
+
+        # List of (symbol, schema, CompressedRelation) triples
+        self.relations = relations
+
+def checkpoint_path(directory, loop):
+    return os.path.join(directory, 'loop-%d.ckpt' % loop)
+
+def write_checkpoint(path, checkpoint):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        marshal.dump((FORMAT, checkpoint.fingerprint, checkpoint.iteration,
+                      checkpoint.done, len(checkpoint.relations)), fh)
+        for _id, schema, compressed in checkpoint.relations:
+            marshal.dump((_id, [str(c) for c in schema.columns]), fh)
+            compressed.dump(fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_path, path)
+
+def read_checkpoint(path):
+    '''Read a checkpoint file; return None if it does not exist'''
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as fh:
+        header = marshal.load(fh)
+        if header[0] != FORMAT:
+            raise CheckpointException('Not a myrial checkpoint: %s' % path)
+        _, fingerprint, iteration, done, count = header
+
+        relations = []
+        for k in xrange(count):
+            _id, columns = marshal.load(fh)
+            schema = relation.Schema.from_strings(columns)
+            relations.append(
+                (_id, schema, encoding.CompressedRelation.load(fh)))
+    return Checkpoint(fingerprint, iteration, done, relations)
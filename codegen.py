@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+'''Compile query plans into specialized python functions
+
+Pipelines of non-blocking operators (FOREACH, UNION and the probe side of a
+JOIN) are fused into a single generated python generator function that
+produces (tuple, multiplicity) pairs.  Blocking operators and leaves (LOAD,
+TABLE, SCAN, DISTINCT, ...) become the inputs of a pipeline; they are
+evaluated by the database as usual.
+
+Generated functions depend only on the shape of the plan, so they are cached
+and shared between all compilers in the process.  The cache holds the most
+recently used PIPELINE_CACHE_SIZE functions.
+'''
+
+import collections
+import operator
+import threading
+
+# Operations that can be fused into a pipeline
+FUSABLE = frozenset(['FOREACH', 'JOIN', 'UNION'])
+
+# Maximum number of compiled pipeline functions that are cached
+PIPELINE_CACHE_SIZE = 256
+
+# Map from generated source code to compiled pipeline functions, in LRU order
+_pipeline_cache = collections.OrderedDict()
+_pipeline_lock = threading.Lock()
+
+class VarRow:
+    '''A row held in a local variable of the generated function'''
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+
+    def column(self, index):
+        return '%s[%d]' % (self.name, index)
+
+    def tuple_expr(self):
+        return self.name
+
+class ColumnsRow:
+    '''A row whose columns are individual python expressions'''
+    def __init__(self, exprs, count):
+        self.exprs = exprs
+        self.count = count
+
+    def column(self, index):
+        return self.exprs[index]
+
+    def tuple_expr(self):
+        return '(%s,)' % ', '.join(self.exprs)
+
+class ConcatRow:
+    '''The concatenation of two rows, as produced by a join'''
+    def __init__(self, left, right, offset):
+        self.left = left
+        self.right = right
+        self.offset = offset
+        self.count = '%s * %s' % (left.count, right.count)
+
+    def column(self, index):
+        if index < self.offset:
+            return self.left.column(index)
+        return self.right.column(index - self.offset)
+
+    def tuple_expr(self):
+        return '(%s + %s)' % (self.left.tuple_expr(), self.right.tuple_expr())
+
+def key_expr(columns):
+    '''Return a python expression for a hash key over column expressions'''
+    if len(columns) == 1:
+        return columns[0]
+    return '(%s,)' % ', '.join(columns)
+
+def split_join_attributes(expr):
+    '''Split join attributes into left and right column indexes
+
+    Return None if some join attribute does not compare a column of the
+    left input with a column of the right input.
+    '''
+    offset = expr.children[0].schema.num_columns()
+    left_indexes = []
+    right_indexes = []
+    for x, y in expr.kwargs['join_attributes']:
+        if x > y:
+            x, y = y, x
+        if x >= offset or y < offset:
+            return None
+        left_indexes.append(x)
+        right_indexes.append(y - offset)
+    return left_indexes, right_indexes
+
+def hashable_join(expr):
+    '''Return whether a join has attributes to build a hash table on'''
+    split = split_join_attributes(expr)
+    return bool(split and split[0])
+
+class _Generator:
+    '''Generate the source code of a pipeline in produce/consume style'''
+
+    def __init__(self):
+        self.constants = []
+        self.prologue = []
+        self.body = []
+
+        # List of (operation, interpret) pairs that feed the pipeline
+        self.inputs = []
+        self.nvars = 0
+
+    def new_var(self, prefix):
+        self.nvars += 1
+        return '%s%d' % (prefix, self.nvars)
+
+    def add_constant(self, prefix, source):
+        name = self.new_var(prefix)
+        self.constants.append((name, source))
+        return name
+
+    def add_input(self, expr, interpret=False):
+        self.inputs.append((expr, interpret))
+        return '_inputs[%d]' % (len(self.inputs) - 1)
+
+    def emit(self, depth, line):
+        self.body.append('    ' * depth + line)
+
+    def emit_yield(self, row, depth):
+        self.emit(depth, 'yield %s, %s' % (row.tuple_expr(), row.count))
+
+    def produce(self, expr, depth, consume):
+        '''Emit code that passes every row of expr to consume(row, depth)'''
+        if expr.type == 'FOREACH':
+            self.produce_foreach(expr, depth, consume)
+        elif expr.type == 'UNION':
+            for child in expr.children:
+                self.produce(child, depth, consume)
+        elif (expr.type == 'JOIN' and hashable_join(expr) and
+              expr.kwargs.get('algorithm') != 'nested_loop'):
+            # Joins planned as nested loops are left to the interpreter
+            self.produce_join(expr, depth, consume)
+        else:
+            source = self.add_input(expr, interpret=expr.type in FUSABLE)
+            var = self.new_var('t')
+            count = self.new_var('c')
+            self.emit(depth, 'for %s, %s in %s:' % (var, count, source))
+            consume(VarRow(var, count), depth + 1)
+
+    def produce_foreach(self, expr, depth, consume):
+        column_indexes = expr.kwargs['column_indexes']
+
+        def consume_foreach(row, depth):
+            if isinstance(row, VarRow) and len(column_indexes) > 1:
+                getter = self.add_constant('_p', '_itemgetter(%s)' % ', '.join(
+                    str(i) for i in column_indexes))
+                var = self.new_var('t')
+                self.emit(depth, '%s = %s(%s)' % (var, getter, row.name))
+                consume(VarRow(var, row.count), depth)
+            else:
+                consume(ColumnsRow([row.column(i) for i in column_indexes],
+                                   row.count), depth)
+
+        self.produce(expr.children[0], depth, consume_foreach)
+
+    def produce_join(self, expr, depth, consume):
+        offset = expr.children[0].schema.num_columns()
+        indexes = split_join_attributes(expr)
+        build = expr.kwargs.get('build', 1)
+        probe = 1 - build
+
+        # Build a hash table over one input before probing with the other;
+        # the database builds it, charging its memory account
+        source = self.add_input(expr.children[build])
+        key = self.add_constant('_k', '_itemgetter(%s)' % ', '.join(
+            str(i) for i in indexes[build]))
+        lookup = self.new_var('_g')
+        self.prologue.append('%s = _hash_table(%s, %s).get' % (
+            lookup, source, key))
+
+        def consume_probe(row, depth):
+            key = key_expr([row.column(i) for i in indexes[probe]])
+            var = self.new_var('t')
+            count = self.new_var('c')
+            self.emit(depth, 'for %s, %s in %s(%s, ()):' % (
+                var, count, lookup, key))
+            match = VarRow(var, count)
+            if build == 1:
+                consume(ConcatRow(row, match, offset), depth + 1)
+            else:
+                consume(ConcatRow(match, row, offset), depth + 1)
+
+        self.produce(expr.children[probe], depth, consume_probe)
+
+    def source(self):
+        lines = ['%s = %s' % c for c in self.constants]
+        defaults = ''.join(', %s=%s' % (c, c) for c, _ in self.constants)
+        lines.append('def _pipeline(_inputs, _hash_table%s):' % defaults)
+        lines.extend('    ' + line for line in self.prologue)
+        lines.extend(self.body)
+        return '\n'.join(lines) + '\n'
+
+def compile_source(source):
+    '''Return the pipeline function for generated source, compiling it once'''
+    with _pipeline_lock:
+        fn = _pipeline_cache.pop(source, None)
+        if fn is not None:
+            _pipeline_cache[source] = fn
+            return fn
+
+    namespace = {'_itemgetter' : operator.itemgetter}
+    exec compile(source, '<myrial pipeline>', 'exec') in namespace
+    fn = namespace['_pipeline']
+    with _pipeline_lock:
+        # Keep the function compiled by a concurrent miss, if any, so that
+        # every caller shares one function
+        fn = _pipeline_cache.pop(source, fn)
+        _pipeline_cache[source] = fn
+        while len(_pipeline_cache) > PIPELINE_CACHE_SIZE:
+            _pipeline_cache.popitem(last=False)
+    return fn
+
+def generate(expr):
+    '''Generate the source of a pipeline rooted at expr
+
+    Return a tuple of the source and the list of (operation, interpret)
+    inputs that must be passed to the compiled function.
+    '''
+    gen = _Generator()
+    gen.produce(expr, 1, gen.emit_yield)
+    return gen.source(), gen.inputs
+
+class PlanCompiler:
+    '''Evaluate operations by running compiled pipelines'''
+
+    def __init__(self, database):
+        self.database = database
+
+    def evaluate(self, expr):
+        source, inputs = generate(expr)
+        fn = compile_source(source)
+
+        # Inputs that could not be fused are evaluated by the interpreter
+        iterators = []
+        for op, interpret in inputs:
+            if interpret:
+                iterators.append(self.database.interpret(op))
+            else:
+                iterators.append(self.database.evaluate(op))
+
+        if self.database.account is None:
+            return fn(iterators, self.__hash_table)
+
+        # Bytes charged for the pipeline's hash tables
+        charges = []
+        def hash_table(pairs, key):
+            table, charged = self.database.hash_table(pairs, key)
+            charges.append(charged)
+            return table
+        return self.__released(fn(iterators, hash_table), charges)
+
+    def __hash_table(self, pairs, key):
+        return self.database.hash_table(pairs, key)[0]
+
+    def __released(self, pairs, charges):
+        '''Yield pairs, then release the memory charged for hash tables'''
+        try:
+            for pair in pairs:
+                yield pair
+        finally:
+            self.database.account.release(sum(charges))
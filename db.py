@@ -1,9 +1,20 @@
 #!/usr/bin/python
 
+import approx
+import codegen
+import encoding
+import graph
+import joins
+import loader
+import memory
 import relation
 
 import collections
+import copy
 import itertools
+import operator
+import random
+import threading
 
 class Operation:
     def  __init__(self, _type, schema, children=[], **kwargs):
@@ -26,21 +37,72 @@ class Operation:
 RelationKey = collections.namedtuple('RelationKey',
                                      ['user', 'program', 'relation'])
 
-StoredRelation = collections.namedtuple('StoredRelation', ['bag', 'schema'])
+# A stored relation is a tuple of chunks whose sum is the relation's
+# contents.  Chunks are bags (collections.Counter instances) or, in a
+# compressed database, encoding.CompressedRelation instances; they are never
+# modified once stored.
+StoredRelation = collections.namedtuple('StoredRelation', ['chunks', 'schema'])
+
+def append_chunk(chunks, bag, encode=lambda bag: bag):
+    '''Return a tuple of chunks with a bag appended
+
+    encode converts a bag into its stored form.  Trailing chunks are merged
+    while a chunk has no more distinct tuples than the one after it, which
+    keeps the number of chunks logarithmic in the size of the relation.
+    '''
+    if not bag:
+        return chunks
+    chunks = chunks + (encode(bag),)
+    while len(chunks) > 1 and len(chunks[-2]) <= len(chunks[-1]):
+        merged = to_bag(itertools.chain(chunks[-2].iteritems(),
+                                        chunks[-1].iteritems()))
+        chunks = chunks[:-2] + (encode(merged),)
+    return chunks
 
 class Database:
+    # Receives events for each evaluated operation; see tracing.Tracer
+    tracer = None
+
     def evaluate(self, expr):
         '''Evaluate an operation
 
-        The return value is an iterator over tuples that match the schema
-        in expr.schema.
+        The return value is an iterator over (tuple, multiplicity) pairs,
+        where each tuple matches the schema in expr.schema.  A tuple may
+        appear in more than one pair; its multiplicity is the sum of the
+        pairs' multiplicities.
         '''
+        if self.tracer is not None:
+            return self.tracer.trace_operator(expr, self.interpret)
+        return self.interpret(expr)
+
+    def interpret(self, expr):
+        '''Evaluate an operation by dispatching to the operator's method'''
         method = getattr(self, expr.type.lower())
         return method(expr, **expr.kwargs)
 
     def evaluate_to_bag(self, expr):
         '''Return a bag (collections.Counter instance) for the expression'''
-        return collections.Counter(self.evaluate(expr))
+        return to_bag(self.evaluate(expr))
+
+    def evaluate_to_elements(self, expr):
+        '''Return an iterator over the tuples of the expression
+
+        Each tuple is repeated according to its multiplicity.
+        '''
+        return elements(self.evaluate(expr))
+
+def to_bag(pairs):
+    '''Sum (tuple, multiplicity) pairs into a collections.Counter'''
+    bag = collections.Counter()
+    get = bag.get
+    for tpl, count in pairs:
+        bag[tpl] = get(tpl, 0) + count
+    return bag
+
+def elements(pairs):
+    '''Expand (tuple, multiplicity) pairs into repeated tuples'''
+    return itertools.chain.from_iterable(
+        itertools.repeat(tpl, count) for tpl, count in pairs)
 
 def columns_match(tpl, column_pairs):
     '''Return whether tuple fields agree on a list of column pairs'''
@@ -50,58 +112,262 @@ def columns_match(tpl, column_pairs):
     return True
 
 class LocalDatabase(Database):
-    '''A local evaluator implemented entirely in python'''
+    '''A local evaluator implemented entirely in python
+
+    Relations are versioned: writers build a new mapping of relations and
+    install it atomically, and each query reads the version that was
+    current when it started.  Readers therefore never block, and never see
+    a partially applied write.
+    '''
 
-    def __init__(self):
-        # Mapping from RelationKey to StoredRelation instances
+    def __init__(self, compiled=False, load_cache=None, compressed=False):
+        # Mapping from RelationKey to StoredRelation instances.  The mapping
+        # is never modified; commits replace it with a new version.
         self.db = {}
+        self.commit_lock = threading.Lock()
 
-    @staticmethod
-    def __valid_input_str(x):
-        y = x.strip()
-        if len(y) == 0:
-            return False
-        if y.startswith('#'):
-            return False
-        return True
+        # The database that commits are applied to; snapshots refer back to
+        # the database they were taken from
+        self.root = self
+
+        # Cache of parsed input files; None disables caching
+        self.load_cache = load_cache
+
+        # Whether stored relations are kept in compressed blocks
+        self.compressed = compressed
+
+        # Compiles pipelines of operators into python code, if requested
+        self.compiler = None
+        if compiled:
+            self.compiler = codegen.PlanCompiler(self)
+
+        # Account charged for the memory used by queries; see accounted()
+        self.account = None
+
+        # Whether this is a snapshot, which reads a single version
+        self.pinned = False
+
+    def evaluate(self, expr):
+        # Queries read a single version of the database
+        if not self.pinned and expr.type not in ('REPLACE', 'INSERT'):
+            return self.snapshot().evaluate(expr)
+
+        if self.tracer is not None:
+            return self.tracer.trace_operator(expr, self.__evaluate_operator)
+        return self.__evaluate_operator(expr)
+
+    def __evaluate_operator(self, expr):
+        if self.compiler is not None and expr.type in codegen.FUSABLE:
+            return self.compiler.evaluate(expr)
+        return self.interpret(expr)
+
+    def snapshot(self):
+        '''Return a view of the current version of the database'''
+        view = copy.copy(self)
+        view.db = self.relations()
+        view.pinned = True
+        if self.compiler is not None:
+            view.compiler = codegen.PlanCompiler(view)
+        return view
+
+    def accounted(self, account):
+        '''Return a view of the database that charges memory to account
+
+        The view reads and writes the same relations as this database.
+        '''
+        view = self.__view()
+        view.account = account
+        return view
+
+    def traced(self, tracer):
+        '''Return a view of the database that sends events to tracer
+
+        The view reads and writes the same relations as this database.
+        '''
+        view = self.__view()
+        view.tracer = tracer
+        return view
+
+    def __view(self):
+        view = copy.copy(self)
+        view.db = None
+        if self.compiler is not None:
+            view.compiler = codegen.PlanCompiler(view)
+        return view
+
+    def relations(self):
+        '''Return the mapping of relations read by this database'''
+        if self.pinned:
+            return self.db
+        return self.root.db
+
+    def commit(self, relation_key, update):
+        '''Atomically install a new version of one relation
+
+        update is called with the current StoredRelation, or None, and
+        returns its replacement, or None to delete the relation.
+        '''
+        root = self.root
+        with root.commit_lock:
+            db = dict(root.db)
+            relation = update(db.get(relation_key))
+            if relation is None:
+                db.pop(relation_key, None)
+            else:
+                db[relation_key] = relation
+            root.db = db
 
     def __evaluate_children(self, children):
         return [self.evaluate(c) for c in children]
 
     def load(self, expr, path):
-        for line in open(path):
-            if LocalDatabase.__valid_input_str(line):
-                yield expr.schema.tuple_from_string(line[:-1])
+        paths = loader.expand_path(path)
+
+        # Inputs too large to be cached are streamed, rather than parsed
+        # into a bag that the cache would drop
+        if self.load_cache is None or not self.load_cache.admits(paths):
+            if loader.use_parallel(paths):
+                return loader.load_bag(paths, expr.schema).iteritems()
+            return loader.parse_files(paths, expr.schema)
+        return self.__load_cached(expr, path, paths)
+
+    def __load_cached(self, expr, path, paths):
+        parse = lambda: loader.load_bag(paths, expr.schema)
+        bag = self.load_cache.get(path, expr.schema, parse, paths)
+
+        # The program keeps the bag alive while reading it, even if the
+        # cache evicts it, so it is charged for the bag
+        charged = 0
+        if self.account is not None:
+            charged = memory.container_bytes(bag)
+            self.account.charge(charged)
+        try:
+            for pair in bag.iteritems():
+                yield pair
+        finally:
+            self.__release(charged)
 
     def table(self, expr, tuple_list):
-        return (t for t in tuple_list)
+        return ((t, 1) for t in tuple_list)
+
+    def join(self, expr, join_attributes, algorithm='nested_loop', build=1):
+        '''Join two inputs
 
-    def join(self, expr, join_attributes):
+        algorithm is 'nested_loop' or 'hash'; a hash join builds a table
+        over the input whose index is build and probes it with the other.
+        A hash join needs every join attribute to compare a column of the
+        left input with one of the right; otherwise a nested loop is used.
+        '''
         assert len(expr.children) == 2
 
+        if algorithm == 'hash':
+            split = codegen.split_join_attributes(expr)
+            if split and split[0]:
+                return self.__hash_join(expr, split, build)
+
         # Compute the cross product of the children and flatten
         cis = self.__evaluate_children(expr.children)
         p1 = itertools.product(*cis)
-        p2 = (x + y for (x,y) in p1)
+        p2 = ((x + y, c1 * c2) for ((x, c1), (y, c2)) in p1)
 
         # Return tuples that match on the join conditions
-        return (tpl for tpl in p2 if columns_match(tpl, join_attributes))
+        return ((tpl, count) for (tpl, count) in p2
+                if columns_match(tpl, join_attributes))
+
+    def __hash_join(self, expr, split, build):
+        cis = self.__evaluate_children(expr.children)
+        build_key = operator.itemgetter(*split[build])
+        probe_key = operator.itemgetter(*split[1 - build])
+        table, charged = self.hash_table(cis[build], build_key)
+
+        try:
+            lookup = table.get
+            for tpl, count in cis[1 - build]:
+                for match, match_count in lookup(probe_key(tpl), ()):
+                    if build == 1:
+                        yield tpl + match, count * match_count
+                    else:
+                        yield match + tpl, count * match_count
+        finally:
+            self.__release(charged)
+
+    def hash_table(self, pairs, key):
+        '''Index pairs by the key of their tuples, charging the account
+
+        Return the table, a dict from keys to lists of pairs, and the number
+        of bytes charged for it.
+        '''
+        table = {}
+        def add(pairs):
+            for tpl, count in pairs:
+                table.setdefault(key(tpl), []).append((tpl, count))
+        return table, memory.collect(pairs, add, table, self.account)
+
+    def multijoin(self, expr, join_attributes):
+        cis = self.__evaluate_children(expr.children)
+        schemas = [c.schema for c in expr.children]
+
+        # Every input pair is indexed in a trie; charge for the pairs as
+        # they are read
+        inputs, charged = self.__collect_lists(cis)
+        try:
+            for pair in joins.generic_join(schemas, inputs, join_attributes):
+                yield pair
+        finally:
+            self.__release(charged)
 
     def limit(self, expr, count):
         assert len(expr.children) == 1
         cis = self.__evaluate_children(expr.children)
-        return itertools.islice(cis[0], count)
+        for tpl, multiplicity in cis[0]:
+            if count <= 0:
+                break
+            multiplicity = min(multiplicity, count)
+            count -= multiplicity
+            yield tpl, multiplicity
 
     def distinct(self, expr):
         assert len(expr.children) == 1
         cis = self.__evaluate_children(expr.children)
-        s = set(cis[0])
-        return iter(s)
+        s = set()
+        charged = memory.collect((tpl for tpl, _ in cis[0]), s.update, s,
+                                 self.account)
+        try:
+            for tpl in s:
+                yield tpl, 1
+        finally:
+            self.__release(charged)
+
+    def sample(self, expr, fraction=None, size=None, seed=None):
+        '''Sample the elements of a relation
+
+        Each element is kept with probability fraction, or, if fraction is
+        None, a uniform sample of size elements is taken.
+        '''
+        assert len(expr.children) == 1
+        cis = self.__evaluate_children(expr.children)
+        rng = random.Random(seed)
+        if fraction is not None:
+            return approx.bernoulli(cis[0], fraction, rng)
+        return approx.reservoir(cis[0], size, rng).iteritems()
+
+    def approx_distinct(self, expr, precision=12):
+        '''Estimate the number of distinct tuples in a relation
+
+        The result is one (estimate, low, high) tuple, where low and high
+        bound the true count with about 95% confidence.
+        '''
+        assert len(expr.children) == 1
+        cis = self.__evaluate_children(expr.children)
+        sketch = approx.HyperLogLog(precision)
+        sketch.update(tpl for tpl, _ in cis[0])
+        return iter([(sketch.bounds(), 1)])
 
     def foreach(self, expr, column_indexes):
         assert len(expr.children) == 1
         cis = self.__evaluate_children(expr.children)
-        return (tuple([tpl[i] for i in column_indexes]) for tpl in cis[0])
+        return ((tuple([tpl[i] for i in column_indexes]), count)
+                for tpl, count in cis[0])
 
     def union(self, expr):
         assert len(expr.children) == 2
@@ -111,38 +377,155 @@ class LocalDatabase(Database):
     def intersect(self, expr):
         assert len(expr.children) == 2
         cis = self.__evaluate_children(expr.children)
-        bags = [collections.Counter(ci) for ci in cis]
-        return (bags[0] & bags[1]).elements()
+        bags = [to_bag(ci) for ci in cis]
+        return (bags[0] & bags[1]).iteritems()
 
     def diff(self, expr):
         assert len(expr.children) == 2
         cis = self.__evaluate_children(expr.children)
 
-        bags = [collections.Counter(ci) for ci in cis]
-        return (bags[0] - bags[1]).elements()
+        bags = [to_bag(ci) for ci in cis]
+        return (bags[0] - bags[1]).iteritems()
+
+    def closure(self, expr):
+        '''Extend the first child along the edges of the last child
+
+        With a single child, the child provides both the seed pairs and the
+        edges, which computes its transitive closure.
+        '''
+        assert len(expr.children) in (1, 2)
+        cis = self.__evaluate_children(expr.children)
+        seed, charged = self.__collect_bag(cis[0])
+        try:
+            if len(cis) == 1:
+                edges = seed.iterkeys()
+            else:
+                # The edges are read into a list before their index is
+                # built; the list is charged for the index, which is no
+                # larger
+                lists, edges_charged = self.__collect_lists(
+                    [(tpl for tpl, _ in cis[1])])
+                charged += edges_charged
+                edges = lists[0]
+            for pair in graph.closure(seed, edges):
+                yield pair
+        finally:
+            self.__release(charged)
 
     def scan(self, expr, relation_key):
         assert len(expr.children) == 0
-        bag = self.db[relation_key].bag
-        return bag.elements()
+        chunks = self.relations()[relation_key].chunks
+        if len(chunks) == 1:
+            return chunks[0].iteritems()
+        return itertools.chain.from_iterable(c.iteritems() for c in chunks)
+
+    def drop_program(self, program):
+        '''Delete every relation stored by a program'''
+        for key in self.root.db.keys():
+            if key.program == program:
+                self.commit(key, lambda relation: None)
 
     def get_schema(self, relation_key):
-        return self.db[relation_key].schema
+        return self.relations()[relation_key].schema
+
+    def cardinality(self, relation_key):
+        '''Return the number of (tuple, multiplicity) pairs in a relation'''
+        return sum(len(chunk)
+                   for chunk in self.relations()[relation_key].chunks)
+
+    def __release(self, nbytes):
+        if nbytes:
+            self.account.release(nbytes)
+
+    def __collect_lists(self, iterators):
+        '''Read iterators into lists; return the lists and the bytes charged'''
+        lists = []
+        charged = 0
+        try:
+            for items in iterators:
+                values = []
+                charged += memory.collect(items, values.extend, values,
+                                          self.account)
+                lists.append(values)
+        except memory.MemoryBudgetExceeded:
+            self.__release(charged)
+            raise
+        return lists, charged
+
+    def __collect_bag(self, pairs):
+        '''Sum pairs into a bag; return the bag and the bytes charged'''
+        bag = collections.Counter()
+        get = bag.get
+        def add(pairs):
+            for tpl, count in pairs:
+                bag[tpl] = get(tpl, 0) + count
+        return bag, memory.collect(pairs, add, bag, self.account)
+
+    def __store(self, relation_key, update):
+        '''Commit an update to a stored relation, accounting for its memory
+        and tracing it if requested'''
+        if self.tracer is not None:
+            update = self.__traced_update(relation_key, update)
+        if self.account is None:
+            self.commit(relation_key, update)
+            return
+
+        def accounted(relation):
+            replacement = update(relation)
+            size = 0
+            if replacement is not None:
+                size = memory.relation_bytes(replacement.chunks)
+            if relation is not None:
+                size -= memory.relation_bytes(relation.chunks)
+            if size > 0:
+                self.account.charge(size)
+            else:
+                self.account.release(-size)
+            return replacement
+        self.commit(relation_key, accounted)
+
+    def encode(self, bag):
+        '''Convert a bag into the form in which it is stored'''
+        if self.compressed:
+            return encoding.CompressedRelation.from_pairs(bag.iteritems())
+        return bag
+
+    def __traced_update(self, relation_key, update):
+        '''Wrap an update to emit an event describing the stored relation'''
+        def traced(relation):
+            replacement = update(relation)
+            if replacement is not None:
+                self.tracer.emit(
+                    'materialize', relation=relation_key.relation,
+                    rows=sum(len(c) for c in replacement.chunks),
+                    bytes=memory.relation_bytes(replacement.chunks))
+            return replacement
+        return traced
+
+    def put(self, relation_key, bag, schema):
+        '''Replace a relation with the contents of a bag'''
+        chunks = (self.encode(bag),)
+        self.__store(relation_key, lambda relation: StoredRelation(
+            chunks=chunks, schema=schema))
 
     def replace(self, expr, relation_key):
         assert len(expr.children) == 1
-        bag = self.evaluate_to_bag(expr.children[0])
-        self.db[relation_key] = StoredRelation(
-            bag=bag, schema=expr.children[0].schema)
+        bag, charged = self.__collect_bag(self.evaluate(expr.children[0]))
+        self.__release(charged)
+        self.put(relation_key, bag, expr.children[0].schema)
 
     def insert(self, expr, relation_key):
         assert len(expr.children) == 1
-
-        if not relation_key in self.db:
-            self.db[relation_key] = StoredRelation(
-                bag=collections.Counter(), schema=expr.children[0].schema)
-
-        bag, schema = self.db[relation_key]
-        schema.check_compatible(expr.children[0].schema)
-
-        bag.update(self.evaluate_to_bag(expr.children[0]))
+        bag, charged = self.__collect_bag(self.evaluate(expr.children[0]))
+        self.__release(charged)
+
+        def append(relation):
+            if relation is None:
+                return StoredRelation(
+                    chunks=append_chunk((), bag, self.encode),
+                    schema=expr.children[0].schema)
+            relation.schema.check_compatible(expr.children[0].schema)
+            return StoredRelation(
+                chunks=append_chunk(relation.chunks, bag, self.encode),
+                schema=relation.schema)
+        self.__store(relation_key, append)
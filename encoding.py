@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+'''Compressed encodings of relations
+
+A compressed relation sorts a bag's tuples and splits them into blocks of
+rows.  Each column of each block, and the block's multiplicities, are stored
+in whichever of these encodings is smallest:
+
+  plain  - the values themselves
+  rle    - run-length encoding, for columns with few distinct values
+  delta  - varint-encoded differences, for sorted integer columns
+  for    - frame of reference: fixed-width offsets from the block minimum
+
+Blocks are decoded one at a time as a relation is scanned, so a relation is
+never fully decompressed.  Encoded blocks consist only of strings, integers
+and tuples, so they are written to disk with marshal.
+'''
+
+import array
+import itertools
+import marshal
+import sys
+
+BLOCK_SIZE = 1024
+
+FORMAT = 'MYRZ1'
+
+# Typecodes of unsigned arrays by item size
+_typecodes = {}
+for _t in 'LIHB':
+    _typecodes[array.array(_t).itemsize] = _t
+
+def encode_varints(values):
+    '''Encode non-negative integers as a string of varints'''
+    out = bytearray()
+    for v in values:
+        while v >= 0x80:
+            out.append((v & 0x7f) | 0x80)
+            v >>= 7
+        out.append(v)
+    return str(out)
+
+def decode_varints(data):
+    values = []
+    v = 0
+    shift = 0
+    for b in bytearray(data):
+        v |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append(v)
+            v = 0
+            shift = 0
+    return values
+
+def zigzag(v):
+    '''Map signed integers onto non-negative ones: 0, -1, 1, -2 ...'''
+    if v >= 0:
+        return v << 1
+    return ((-v) << 1) - 1
+
+def unzigzag(v):
+    if v & 1:
+        return -((v + 1) >> 1)
+    return v >> 1
+
+def _pack(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+def _unpack(typecode, data):
+    a = array.array(typecode)
+    a.fromstring(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def encode_rle(values):
+    run_values = []
+    run_lengths = []
+    for value, run in itertools.groupby(values):
+        run_values.append(value)
+        run_lengths.append(sum(1 for _ in run))
+    return ('rle', tuple(run_values), encode_varints(run_lengths))
+
+def encode_delta(values):
+    '''Encode a non-decreasing column of integers'''
+    deltas = [zigzag(values[0])]
+    deltas.extend(y - x for x, y in itertools.izip(values, values[1:]))
+    return ('delta', encode_varints(deltas))
+
+def encode_for(values):
+    base = min(values)
+    span = max(values) - base
+    for width in sorted(_typecodes):
+        if span < 1 << (8 * width):
+            typecode = _typecodes[width]
+            return ('for', base, typecode,
+                    _pack(typecode, [v - base for v in values]))
+    return None
+
+def encoded_size(column):
+    '''Estimate the bytes used by an encoded column'''
+    size = 0
+    for part in column[1:]:
+        if isinstance(part, str):
+            size += len(part)
+        elif isinstance(part, tuple):
+            size += sum(len(v) if isinstance(v, str) else 8 for v in part)
+        else:
+            size += 8
+    return size
+
+def encode_column(values):
+    '''Return the smallest encoding of a list of values'''
+    candidates = [('plain', tuple(values)), encode_rle(values)]
+    if all(type(v) in (int, long) for v in values):
+        if all(x <= y for x, y in itertools.izip(values, values[1:])):
+            candidates.append(encode_delta(values))
+        candidates.append(encode_for(values))
+    return min((c for c in candidates if c is not None), key=encoded_size)
+
+def decode_column(column):
+    kind = column[0]
+    if kind == 'plain':
+        return column[1]
+    elif kind == 'rle':
+        _, run_values, run_lengths = column
+        return list(itertools.chain.from_iterable(
+            itertools.repeat(v, n)
+            for v, n in itertools.izip(run_values,
+                                       decode_varints(run_lengths))))
+    elif kind == 'delta':
+        deltas = decode_varints(column[1])
+        values = []
+        v = unzigzag(deltas[0])
+        values.append(v)
+        for d in itertools.islice(deltas, 1, None):
+            v += d
+            values.append(v)
+        return values
+    elif kind == 'for':
+        _, base, typecode, data = column
+        return [base + v for v in _unpack(typecode, data)]
+    raise ValueError('Unknown column encoding: %s' % kind)
+
+def encode_block(pairs):
+    '''Encode a list of (tuple, multiplicity) pairs'''
+    tuples = [tpl for tpl, _ in pairs]
+    columns = tuple(encode_column(list(c)) for c in zip(*tuples))
+    counts = encode_column([count for _, count in pairs])
+    return (len(pairs), columns, counts)
+
+def decode_block(block):
+    n, columns, counts = block
+    values = [decode_column(c) for c in columns]
+    return itertools.izip(itertools.izip(*values), decode_column(counts))
+
+class CompressedRelation:
+    '''An immutable bag of tuples stored as compressed blocks
+
+    The relation supports the read-only parts of the collections.Counter
+    interface used to store relations: iteritems() and len().
+    '''
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.size = sum(block[0] for block in blocks)
+
+    @classmethod
+    def from_pairs(cls, pairs, block_size=BLOCK_SIZE):
+        '''Compress (tuple, multiplicity) pairs with distinct tuples'''
+        pairs = sorted(pairs)
+        blocks = tuple(encode_block(pairs[i:i + block_size])
+                       for i in xrange(0, len(pairs), block_size))
+        return cls(blocks)
+
+    def iteritems(self):
+        return itertools.chain.from_iterable(
+            decode_block(block) for block in self.blocks)
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        '''Estimate the bytes used by the encoded blocks'''
+        return sum(encoded_size(c) for block in self.blocks
+                   for c in block[1] + (block[2],))
+
+    def dump(self, fh):
+        '''Write the relation to a binary file'''
+        marshal.dump((FORMAT, self.blocks), fh)
+
+    @classmethod
+    def load(cls, fh):
+        '''Read a relation written by dump'''
+        data = marshal.load(fh)
+        if data[0] != FORMAT:
+            raise IOError('Not a compressed myrial relation')
+        return cls(data[1])
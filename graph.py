@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+'''Graph algorithms over binary relations'''
+
+import array
+import itertools
+
+class CsrGraph:
+    '''A directed graph stored as a compressed sparse row adjacency index
+
+    Nodes are arbitrary python values; they are numbered densely in order of
+    appearance.  The successors of node i are
+    targets[offsets[i]:offsets[i + 1]].
+    '''
+
+    def __init__(self, edges):
+        '''Build the index from an iterable of (source, dest) pairs'''
+        self.index = {}
+        self.nodes = []
+
+        sources = array.array('l')
+        dests = array.array('l')
+        for u, v in edges:
+            sources.append(self.node_id(u))
+            dests.append(self.node_id(v))
+
+        n = len(self.nodes)
+        self.offsets = array.array('l', [0]) * (n + 1)
+        for u in sources:
+            self.offsets[u + 1] += 1
+        for i in xrange(n):
+            self.offsets[i + 1] += self.offsets[i]
+
+        self.targets = array.array('l', [0]) * len(sources)
+        position = array.array('l', self.offsets)
+        for u, v in itertools.izip(sources, dests):
+            self.targets[position[u]] = v
+            position[u] += 1
+
+    def node_id(self, node):
+        i = self.index.get(node)
+        if i is None:
+            i = self.index[node] = len(self.nodes)
+            self.nodes.append(node)
+        return i
+
+    def num_nodes(self):
+        return len(self.nodes)
+
+    def reachable(self, starts, visited):
+        '''Return the ids of nodes reachable from starts by one or more edges
+
+        visited is a zeroed bytearray with one entry per node; it is zeroed
+        again before returning, so it can be shared between searches.
+        '''
+        offsets = self.offsets
+        targets = self.targets
+        reached = []
+        frontier = [self.index[x] for x in starts if x in self.index]
+        while frontier:
+            next_frontier = []
+            for u in frontier:
+                for k in xrange(offsets[u], offsets[u + 1]):
+                    v = targets[k]
+                    if not visited[v]:
+                        visited[v] = 1
+                        next_frontier.append(v)
+            reached.extend(next_frontier)
+            frontier = next_frontier
+
+        for v in reached:
+            visited[v] = 0
+        return reached
+
+def closure(seed, edges):
+    '''Extend a bag of (source, node) pairs along a set of edges
+
+    seed is a collections.Counter of pairs; edges is an iterable of
+    (source, dest) pairs.  Return (tuple, multiplicity) pairs of the seed,
+    followed by each (source, dest) pair reachable from the seed by one or
+    more edges that is not already in the seed.  This is the fixpoint of
+    the reachability loop in reachable.myl.
+    '''
+    graph = CsrGraph(edges)
+    visited = bytearray(graph.num_nodes())
+
+    starts = {}
+    for (source, node), count in seed.iteritems():
+        yield (source, node), count
+        starts.setdefault(source, []).append(node)
+
+    for source, nodes in starts.iteritems():
+        for v in graph.reachable(nodes, visited):
+            tpl = (source, graph.nodes[v])
+            if tpl not in seed:
+                yield tpl, 1
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+'''Multiway joins
+
+A chain of binary joins materializes every pairwise result, which can be far
+larger than the final output for cyclic queries such as triangles.  The
+generic join below binds one join variable at a time across all inputs, so
+its work is bounded by the size of the output rather than the intermediate
+results.
+'''
+
+import itertools
+
+def flatten_join(expr):
+    '''Flatten a tree of JOIN and MULTIJOIN operations
+
+    Return a pair of the list of non-join inputs, in column order, and the
+    list of join attributes as pairs of column indexes into the
+    concatenation of those inputs.
+    '''
+    if expr.type not in ('JOIN', 'MULTIJOIN'):
+        return [expr], []
+
+    inputs = []
+    attributes = list(expr.kwargs['join_attributes'])
+    if expr.type == 'MULTIJOIN':
+        return list(expr.children), attributes
+
+    offset = 0
+    for child in expr.children:
+        child_inputs, child_attributes = flatten_join(child)
+        inputs.extend(child_inputs)
+        attributes.extend((x + offset, y + offset)
+                          for x, y in child_attributes)
+        offset += child.schema.num_columns()
+    return inputs, attributes
+
+def join_variables(join_attributes):
+    '''Group columns that must be equal into variables
+
+    Return a list of sorted lists of column indexes.
+    '''
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for x, y in join_attributes:
+        parent[find(x)] = find(y)
+
+    classes = {}
+    for x in parent:
+        classes.setdefault(find(x), []).append(x)
+    return sorted(sorted(c) for c in classes.values())
+
+class _Input:
+    '''The columns of one join input that are bound by each variable'''
+
+    def __init__(self, ncols, offset):
+        self.ncols = ncols
+        self.offset = offset
+
+        # Map from variable number to local column indexes
+        self.columns = {}
+
+    def add(self, variable, column):
+        self.columns.setdefault(variable, []).append(column - self.offset)
+
+    def build_trie(self, order, pairs):
+        '''Index (tuple, multiplicity) pairs by variables in the given order
+
+        Interior nodes are dicts keyed by a variable's value; leaves are
+        lists of pairs.  Tuples that disagree on the columns of a variable
+        are dropped.
+        '''
+        levels = [self.columns[v] for v in order if v in self.columns]
+        if not levels:
+            return list(pairs)
+
+        trie = {}
+        for tpl, count in pairs:
+            node = trie
+            for depth, columns in enumerate(levels):
+                value = tpl[columns[0]]
+                if any(tpl[c] != value for c in columns[1:]):
+                    break
+                if depth == len(levels) - 1:
+                    node.setdefault(value, []).append((tpl, count))
+                else:
+                    node = node.setdefault(value, {})
+        return trie
+
+def generic_join(schemas, children, join_attributes):
+    '''Join many inputs at once
+
+    schemas are the schemas of the inputs and children are iterators of
+    their (tuple, multiplicity) pairs.  Return (tuple, multiplicity) pairs
+    of the concatenated tuples that agree on all join attributes.
+    '''
+    inputs = []
+    offset = 0
+    for schema in schemas:
+        inputs.append(_Input(schema.num_columns(), offset))
+        offset += schema.num_columns()
+
+    def input_of(column):
+        for i, _input in enumerate(inputs):
+            if column < _input.offset + _input.ncols:
+                return i
+
+    variables = join_variables(join_attributes)
+    participants = []
+    for v, columns in enumerate(variables):
+        members = set()
+        for column in columns:
+            i = input_of(column)
+            inputs[i].add(v, column)
+            members.add(i)
+        participants.append(sorted(members))
+
+    # Bind the variables shared by the most inputs first
+    order = sorted(range(len(variables)),
+                   key=lambda v: (-len(participants[v]), v))
+    tries = [_input.build_trie(order, child)
+             for _input, child in zip(inputs, children)]
+
+    return _bind(order, participants, tries)
+
+def _bind(order, participants, nodes):
+    if not order:
+        for combination in itertools.product(*nodes):
+            tpl = ()
+            count = 1
+            for t, c in combination:
+                tpl += t
+                count *= c
+            yield tpl, count
+        return
+
+    members = participants[order[0]]
+    smallest = min(members, key=lambda i: len(nodes[i]))
+    for value in nodes[smallest]:
+        children = list(nodes)
+        for i in members:
+            child = nodes[i].get(value)
+            if child is None:
+                break
+            children[i] = child
+        else:
+            for result in _bind(order[1:], participants, children):
+                yield result
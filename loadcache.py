@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+'''A process-wide cache of parsed input files
+
+Relations read by LOAD are cached as bags, keyed by the LOAD path, the
+schema it was parsed with, and the size and modification time of each file
+the path names, so a changed file is never served from the cache.  Entries
+are evicted in least recently used order once the estimated memory used by
+the cached bags exceeds the cache's capacity.  Inputs whose parsed bags
+could not fit are streamed rather than cached; see admits().
+
+Databases only use a cache if they are given one; the server and programs
+run by myrial.evaluate share the cache below.
+'''
+
+import memory
+
+import collections
+import os
+import threading
+
+DEFAULT_CAPACITY = 256 * 1024 * 1024
+
+class LoadCache:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        # Maximum total size, in bytes of memory, of the cached bags
+        self.capacity = capacity
+        self.size = 0
+
+        # Map from cache key to (bag, size) pairs, in LRU order
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(path, schema, files):
+        stats = []
+        for f in files:
+            st = os.stat(f)
+            stats.append((f, st.st_size, st.st_mtime))
+        return (os.path.abspath(path), str(schema),
+                sum(size for _, size, _ in stats), tuple(stats))
+
+    def admits(self, files):
+        '''Return whether the bag parsed from files may fit in the cache
+
+        The size of the bag is estimated from the size of the files.
+        '''
+        size = sum(os.path.getsize(f) for f in files)
+        return memory.LOAD_EXPANSION * size <= self.capacity
+
+    def get(self, path, schema, parse, files=None):
+        '''Return the bag for a LOAD path, calling parse() on a cache miss
+
+        files lists the files named by the path, if it is a directory or
+        a glob.  parse must return a collections.Counter of the files'
+        tuples.  The returned bag is shared and must not be modified.
+        '''
+        if files is None:
+            files = [path]
+        key = LoadCache.cache_key(path, schema, files)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry[0]
+
+        bag = parse()
+        size = memory.container_bytes(bag)
+        with self.lock:
+            # Drop entries for older versions of the file, and any entry
+            # inserted by a concurrent miss on the same key
+            self.__remove(lambda k: k[0] == key[0] and
+                          (k[1] == key[1] or k[2:] != key[2:]))
+            if size <= self.capacity:
+                self.entries[key] = (bag, size)
+                self.size += size
+                while self.size > self.capacity:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+        return bag
+
+    def invalidate(self, path=None):
+        '''Drop the cached entries of a file, or of all files'''
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                abspath = os.path.abspath(path)
+                self.__remove(lambda k: k[0] == abspath)
+
+    def __remove(self, predicate):
+        for key in [k for k in self.entries if predicate(k)]:
+            _, size = self.entries.pop(key)
+            self.size -= size
+
+    def __len__(self):
+        return len(self.entries)
+
+# The cache shared by all databases in the process
+shared = LoadCache()
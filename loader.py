@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+'''Parsing of input files for LOAD
+
+A LOAD path may name a file, a directory (meaning every non-hidden file in
+it) or a glob pattern.  Large inputs are split into byte ranges at line
+boundaries and parsed in parallel by a pool of processes; each process sends
+back one bag per range rather than individual tuples.
+'''
+
+import relation
+
+import collections
+import glob
+import itertools
+import multiprocessing
+import os
+
+# Inputs are split into ranges of roughly this many bytes
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# Inputs smaller than this many bytes are parsed in the calling process
+PARALLEL_THRESHOLD = 32 * 1024 * 1024
+
+# Number of worker processes; the pool is created on first use.  The pool
+# is forked from the thread that creates it, so a multithreaded program such
+# as the server must call get_pool before starting its threads.
+PROCESSES = multiprocessing.cpu_count()
+_pool = None
+
+def valid_input_str(x):
+    '''Return whether a line holds a tuple, rather than a comment or blank'''
+    y = x.strip()
+    if len(y) == 0:
+        return False
+    if y.startswith('#'):
+        return False
+    return True
+
+def expand_path(path):
+    '''Return the sorted list of files named by a LOAD path'''
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if not f.startswith('.') and
+                      os.path.isfile(os.path.join(path, f)))
+    if glob.has_magic(path):
+        return sorted(f for f in glob.glob(path) if os.path.isfile(f))
+    return [path]
+
+def parse_lines(lines, schema):
+    '''Yield (tuple, multiplicity) pairs for the tuples in lines'''
+    for line in lines:
+        if valid_input_str(line):
+            yield schema.tuple_from_string(line[:-1]), 1
+
+def parse_files(paths, schema):
+    for path in paths:
+        with open(path) as fh:
+            for pair in parse_lines(fh, schema):
+                yield pair
+
+def split_file(path, chunk_bytes):
+    '''Split a file into (path, start, end) byte ranges'''
+    size = os.path.getsize(path)
+    return [(path, start, min(start + chunk_bytes, size))
+            for start in xrange(0, size, chunk_bytes)]
+
+def range_lines(path, start, end):
+    '''Yield the lines of a file that start within a byte range'''
+    with open(path) as fh:
+        if start > 0:
+            # The line spanning the start belongs to the previous range
+            fh.seek(start - 1)
+            fh.readline()
+        position = fh.tell()
+        while position < end:
+            line = fh.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def parse_range(args):
+    '''Parse a byte range of a file into a bag; run by worker processes'''
+    path, start, end, columns = args
+    schema = relation.Schema.from_strings(columns)
+    bag = collections.Counter()
+    for tpl, _ in parse_lines(range_lines(path, start, end), schema):
+        bag[tpl] += 1
+    return bag
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(PROCESSES)
+    return _pool
+
+def use_parallel(paths):
+    if PROCESSES <= 1:
+        return False
+    return sum(os.path.getsize(p) for p in paths) >= PARALLEL_THRESHOLD
+
+def load_bag(paths, schema):
+    '''Parse files into a collections.Counter, in parallel if they are large'''
+    columns = [str(c) for c in schema.columns]
+    tasks = [r + (columns,) for path in paths
+             for r in split_file(path, CHUNK_BYTES)]
+
+    if use_parallel(paths) and len(tasks) > 1:
+        parts = get_pool().imap_unordered(parse_range, tasks)
+    else:
+        parts = itertools.imap(parse_range, tasks)
+
+    bag = collections.Counter()
+    for part in parts:
+        bag.update(part)
+    return bag
@@ -1,9 +1,19 @@
+import codegen
 import db
+import encoding
+import loadcache
+import loader
+import memory
 import random
 import relation
+import tracing
 from db import Operation
 
 import collections
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 """
@@ -70,6 +80,17 @@ class LocalDatabaseTests(unittest.TestCase):
                                     if e[1] == d[0]])
     self.assertEqual(actual,expected)
 
+    for build in [0, 1]:
+      ex = Operation('JOIN', schema_out, children=[l1,l2],
+                     join_attributes=[(4,1)], algorithm='hash', build=build)
+      self.assertEqual(self.evaluator.evaluate_to_bag(ex), expected)
+
+    # A join without attributes is a cross product
+    ex = Operation('JOIN', schema_out, children=[l1,l2], join_attributes=[])
+    expected = collections.Counter([e + d for e in self.employee_tuples
+                                    for d in self.department_tuples])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex), expected)
+
   def test_foreach(self):
     l1 = Operation('LOAD', self.employee_schema, path='employees.txt')
     schema_out = relation.Schema.from_strings(['name:string','salary:int'])
@@ -141,6 +162,35 @@ class LocalDatabaseTests(unittest.TestCase):
     expected = collections.Counter(t1[:8])
     self.assertEqual(actual, expected)
 
+  def test_sample(self):
+    schema = relation.Schema.from_strings(['f1:int', 'f2:int'])
+    t1 = [(k, k % 7) for k in range(5000)]
+    c1 = Operation('TABLE', schema, tuple_list=t1)
+
+    ex = Operation('SAMPLE', schema, children=[c1], size=100, seed=1)
+    actual = self.evaluator.evaluate_to_bag(ex)
+    self.assertEqual(sum(actual.values()), 100)
+    self.assertTrue(set(actual) <= set(t1))
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex), actual)
+
+    ex = Operation('SAMPLE', schema, children=[c1], fraction=0.1, seed=1)
+    actual = self.evaluator.evaluate_to_bag(ex)
+    self.assertTrue(350 < sum(actual.values()) < 650)
+    self.assertTrue(set(actual) <= set(t1))
+
+  def test_approx_distinct(self):
+    schema = relation.Schema.from_strings(['f1:int', 'f2:int'])
+    t1 = [(k, k % 7) for k in range(20000)] * 2
+    c1 = Operation('TABLE', schema, tuple_list=t1)
+    schema_out = relation.Schema.from_strings(
+      ['estimate:int', 'low:int', 'high:int'])
+
+    ex = Operation('APPROX_DISTINCT', schema_out, children=[c1])
+    [(estimate, low, high)] = list(self.evaluator.evaluate_to_elements(ex))
+    self.assertTrue(low <= 20000 <= high)
+    self.assertTrue(low <= estimate <= high)
+    self.assertTrue(high - low < 0.1 * 20000)
+
   def test_distinct(self):
     schema = relation.Schema.from_strings(['f1:int', 'f2:int'])
     t1 = [(2*k, 2*k + 1) for k in range(40)]
@@ -189,3 +239,470 @@ class LocalDatabaseTests(unittest.TestCase):
     self.assertEqual(self.evaluator.get_schema(key), schema)
     a3 = self.evaluator.evaluate_to_bag(s1)
     self.assertEqual(a3, collections.Counter(t3))
+
+  def test_closure(self):
+    schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    edges = [(1, 2), (2, 3), (3, 1), (4, 5), (4, 5), (6, 6)]
+    e1 = Operation('TABLE', schema, tuple_list=edges)
+
+    ex = Operation('CLOSURE', schema, children=[e1])
+    expected = collections.Counter(edges)
+    expected.update([(1, 1), (1, 3), (2, 1), (2, 2), (3, 2), (3, 3)])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex), expected)
+
+    # Extend a seed relation along the edges
+    seed = [(7, 2), (7, 2), (8, 4)]
+    s1 = Operation('TABLE', schema, tuple_list=seed)
+    ex = Operation('CLOSURE', schema, children=[s1, e1])
+    expected = collections.Counter(seed + [(7, 3), (7, 1), (8, 5)])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex), expected)
+
+  def test_multijoin(self):
+    schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    edges = [(random.randint(0, 9), random.randint(0, 9)) for k in range(60)]
+    e1 = Operation('TABLE', schema, tuple_list=edges)
+    schema_out = relation.Schema.join([schema, schema, schema],
+                                      ['E1', 'E2', 'E3'])
+
+    # Triangles: E1.dest = E2.source, E2.dest = E3.source, E3.dest = E1.source
+    ex = Operation('MULTIJOIN', schema_out, children=[e1, e1, e1],
+                   join_attributes=[(1, 2), (3, 4), (5, 0)])
+    actual = self.evaluator.evaluate_to_bag(ex)
+    expected = collections.Counter([a + b + c for a in edges for b in edges
+                                    for c in edges if a[1] == b[0] and
+                                    b[1] == c[0] and c[1] == a[0]])
+    self.assertEqual(actual, expected)
+
+    # Equality of two columns of the same input
+    ex = Operation('MULTIJOIN', schema_out, children=[e1, e1, e1],
+                   join_attributes=[(0, 1), (1, 2), (4, 5)])
+    actual = self.evaluator.evaluate_to_bag(ex)
+    expected = collections.Counter([a + b + c for a in edges for b in edges
+                                    for c in edges if a[0] == a[1] == b[0]
+                                    and c[0] == c[1]])
+    self.assertEqual(actual, expected)
+
+  def test_multiplicities(self):
+    schema = relation.Schema.from_strings(['f1:int', 'f2:int'])
+    key1 = db.RelationKey('andrew', 'foo.exe', 'heavy1')
+    key2 = db.RelationKey('andrew', 'foo.exe', 'heavy2')
+
+    # Bags this large can only be processed without expanding them
+    self.evaluator.put(
+      key1, collections.Counter({(1, 2): 10**12, (3, 4): 5}), schema)
+    self.evaluator.put(
+      key2, collections.Counter({(2, 7): 3 * 10**6, (1, 2): 10**11}), schema)
+    s1 = Operation('SCAN', schema, relation_key=key1)
+    s2 = Operation('SCAN', schema, relation_key=key2)
+
+    ex = Operation('DIFF', schema, children=[s1, s2])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex),
+                     collections.Counter({(1, 2): 9 * 10**11, (3, 4): 5}))
+
+    ex = Operation('INTERSECT', schema, children=[s1, s2])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex),
+                     collections.Counter({(1, 2): 10**11}))
+
+    ex = Operation('UNION', schema, children=[s1, s2])
+    self.assertEqual(sum(self.evaluator.evaluate_to_bag(ex).values()),
+                     11 * 10**11 + 3 * 10**6 + 5)
+
+    ex = Operation('DISTINCT', schema, children=[s1])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex),
+                     collections.Counter([(1, 2), (3, 4)]))
+
+    ex = Operation('LIMIT', schema, children=[s1], count=7)
+    self.assertEqual(sum(self.evaluator.evaluate_to_bag(ex).values()), 7)
+
+    schema_join = relation.Schema.join([schema, schema], ['A', 'B'])
+    j = Operation('JOIN', schema_join, children=[s1, s2],
+                  join_attributes=[(1, 2)])
+    ex = Operation('FOREACH', schema, children=[j], column_indexes=[0, 3])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex),
+                     collections.Counter({(1, 7): 3 * 10**18}))
+
+  def test_snapshot_isolation(self):
+    schema = relation.Schema.from_strings(['f1:int', 'f2:int'])
+    key = db.RelationKey('andrew', 'foo.exe', 'log')
+    s1 = Operation('SCAN', schema, relation_key=key)
+
+    def append(k):
+      batch = [(k, i) for i in range(10)]
+      e = Operation('TABLE', schema, tuple_list=batch)
+      self.evaluator.evaluate(Operation('INSERT', schema=None, children=[e],
+                                        relation_key=key))
+
+    append(0)
+    it = self.evaluator.evaluate(s1)
+    append(1)
+
+    # A query started before a write does not see it
+    self.assertEqual(sum(c for _, c in it), 10)
+    self.assertEqual(sum(self.evaluator.evaluate_to_bag(s1).values()), 20)
+
+    # Concurrent readers only ever see whole batches
+    sizes = []
+    def read():
+      for k in range(50):
+        bag = self.evaluator.evaluate_to_bag(s1)
+        sizes.append(sum(bag.values()))
+    readers = [threading.Thread(target=read) for k in range(4)]
+    for r in readers:
+      r.start()
+    for k in range(2, 200):
+      append(k)
+    for r in readers:
+      r.join()
+
+    self.assertTrue(all(size % 10 == 0 for size in sizes))
+    self.assertEqual(sum(self.evaluator.evaluate_to_bag(s1).values()), 2000)
+
+    # Appends are stored in a logarithmic number of chunks
+    self.assertTrue(len(self.evaluator.db[key].chunks) <= 8)
+
+  def test_load_cache(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'edges.txt')
+      with open(path, 'w') as fh:
+        fh.write('1\t2\n1\t2\n')
+
+      cache = loadcache.LoadCache(capacity=1024)
+      evaluator = db.LocalDatabase(load_cache=cache)
+      schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+      ex = Operation('LOAD', schema, path=path)
+
+      self.assertEqual(evaluator.evaluate_to_bag(ex),
+                       collections.Counter({(1, 2): 2}))
+      self.assertEqual(len(cache), 1)
+
+      # Cached results are shared across databases
+      bag = cache.get(path, schema, lambda: self.fail('cache miss'))
+      self.assertEqual(db.LocalDatabase(load_cache=cache).evaluate_to_bag(ex),
+                       bag)
+
+      # A modified file replaces the cached version
+      with open(path, 'w') as fh:
+        fh.write('3\t4\n')
+      os.utime(path, (0, 0))
+      self.assertEqual(evaluator.evaluate_to_bag(ex),
+                       collections.Counter({(3, 4): 1}))
+      self.assertEqual(len(cache), 1)
+
+      # Entries are charged for the memory used by their bags
+      self.assertEqual(cache.size, memory.container_bytes(
+        collections.Counter({(3, 4): 1})))
+
+      # Entries are evicted once the cache exceeds its capacity
+      departments = Operation('LOAD', self.department_schema,
+                              path='departments.txt')
+      bag = db.LocalDatabase().evaluate_to_bag(departments)
+      estimate = memory.LOAD_EXPANSION * os.path.getsize('departments.txt')
+      cache.capacity = max(memory.container_bytes(bag), estimate)
+      self.assertEqual(evaluator.evaluate_to_bag(departments), bag)
+      self.assertEqual(len(cache), 1)
+      self.assertEqual(cache.size, memory.container_bytes(bag))
+
+      # Reading a cached bag charges the program until it is read
+      account = memory.MemoryAccount('test')
+      view = evaluator.accounted(account)
+      self.assertEqual(view.evaluate_to_bag(departments), bag)
+      self.assertEqual(account.peak, cache.size)
+      self.assertEqual(account.used, 0)
+
+      # Inputs too large to be cached are streamed past the cache
+      cache.invalidate()
+      cache.capacity = estimate - 1
+      self.assertEqual(evaluator.evaluate_to_bag(departments), bag)
+      self.assertEqual(len(cache), 0)
+
+      cache.invalidate()
+      self.assertEqual(len(cache), 0)
+      self.assertEqual(cache.size, 0)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_memory_accounting(self):
+    schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    edges = Operation('TABLE', schema,
+                      tuple_list=[(k, k % 10) for k in range(2000)])
+    key = db.RelationKey(user='test', program='memory', relation='edges')
+    account = memory.MemoryAccount('test')
+    view = self.evaluator.accounted(account)
+
+    # Stored relations are charged while they are stored
+    view.evaluate(Operation('REPLACE', schema=None, children=[edges],
+                            relation_key=key))
+    stored = account.used
+    self.assertTrue(stored > 0)
+    self.assertEqual(self.evaluator.cardinality(key), 2000)
+
+    # Operators release their memory once their output has been read
+    ex = Operation('DISTINCT', schema, children=[
+      Operation('SCAN', schema, relation_key=key)])
+    self.assertEqual(len(view.evaluate_to_bag(ex)), 2000)
+    self.assertEqual(account.used, stored)
+    self.assertTrue(account.peak > stored)
+
+    # A program that exceeds its budget fails without storing its result
+    account.budget = stored + 1000
+    big = Operation('TABLE', schema,
+                    tuple_list=[(k, k) for k in range(20000)])
+    big_key = db.RelationKey(user='test', program='memory', relation='big')
+    self.assertRaises(memory.MemoryBudgetExceeded, view.evaluate,
+                      Operation('REPLACE', schema=None, children=[big],
+                                relation_key=big_key))
+    self.assertFalse(big_key in self.evaluator.db)
+    self.assertEqual(account.used, stored)
+
+  def test_join_memory_budget(self):
+    schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    e1 = Operation('TABLE', schema,
+                   tuple_list=[(k, k % 100) for k in range(5000)])
+    e2 = Operation('TABLE', schema,
+                   tuple_list=[(k % 100, k) for k in range(5000)])
+    schema_two = relation.Schema.join([schema, schema], ['E1', 'E2'])
+    schema_three = relation.Schema.join([schema, schema, schema],
+                                        ['E1', 'E2', 'E3'])
+    plans = [
+      Operation('JOIN', schema_two, children=[e1, e2],
+                join_attributes=[(1, 2)], algorithm='hash'),
+      Operation('MULTIJOIN', schema_three, children=[e1, e2, e1],
+                join_attributes=[(1, 2), (3, 4)]),
+      Operation('CLOSURE', schema, children=[e1, e2])]
+
+    # Hash tables, tries and graph indexes are charged while they are used
+    for ex in plans:
+      account = memory.MemoryAccount('test')
+      view = self.evaluator.accounted(account)
+      view.evaluate_to_bag(Operation('LIMIT', ex.schema, children=[ex],
+                                     count=1))
+      self.assertTrue(account.peak > 0)
+      self.assertEqual(account.used, 0)
+
+      account = memory.MemoryAccount('test', budget=10000)
+      view = self.evaluator.accounted(account)
+      self.assertRaises(memory.MemoryBudgetExceeded, view.evaluate_to_bag, ex)
+      self.assertEqual(account.used, 0)
+
+  def test_abandoned_output(self):
+    schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    t1 = Operation('TABLE', schema,
+                   tuple_list=[(k, k % 100) for k in range(5000)])
+    t2 = Operation('TABLE', schema,
+                   tuple_list=[(k % 100, k) for k in range(5000)])
+    schema_three = relation.Schema.join([schema, schema, schema],
+                                        ['E1', 'E2', 'E3'])
+    plans = [
+      Operation('DISTINCT', schema, children=[t1]),
+      Operation('MULTIJOIN', schema_three, children=[t1, t2, t1],
+                join_attributes=[(1, 2), (3, 4)]),
+      Operation('CLOSURE', schema, children=[t1, t2])]
+
+    # Operators whose output is never read are not charged
+    account = memory.MemoryAccount('test')
+    view = self.evaluator.accounted(account)
+    for ex in plans:
+      view.evaluate(ex)
+      union = Operation('UNION', ex.schema, children=[ex.children[0], ex])
+      self.assertEqual(len(view.evaluate_to_bag(
+        Operation('LIMIT', ex.schema, children=[union], count=1))), 1)
+      self.assertEqual(account.used, 0)
+
+  def test_tracing(self):
+    l1 = Operation('LOAD', self.employee_schema, path='employees.txt')
+    l2 = Operation('LOAD', self.department_schema, path='departments.txt')
+    schema_out = relation.Schema.join(
+      [self.employee_schema, self.department_schema],
+      ['Employee', 'Department'])
+    ex = Operation('JOIN', schema_out, children=[l1,l2],
+                    join_attributes=[(1,4)])
+
+    events = []
+    class ListSink(tracing.TraceSink):
+      def record(self, event):
+        events.append(event)
+    view = self.evaluator.traced(tracing.Tracer([ListSink()]))
+    actual = view.evaluate_to_bag(ex)
+
+    opened = [e['operator'] for e in events if e['event'] == 'operator_open']
+    closed = [e for e in events if e['event'] == 'operator_close']
+    self.assertEqual(opened[0], 'JOIN')
+    self.assertEqual(sorted(opened), ['JOIN', 'LOAD', 'LOAD'])
+    self.assertEqual(closed[-1]['operator'], 'JOIN')
+    self.assertEqual(closed[-1]['tuples'], sum(actual.values()))
+    self.assertEqual(sorted(e['rows'] for e in closed[:2]),
+                     sorted([len(self.department_tuples),
+                             len(self.employee_tuples)]))
+
+    # Untraced databases emit nothing
+    self.evaluator.evaluate_to_bag(ex)
+    self.assertEqual(len(events), 6)
+
+class CompiledLocalDatabaseTests(LocalDatabaseTests):
+  '''Run the evaluator tests against compiled pipelines'''
+  def setUp(self):
+    LocalDatabaseTests.setUp(self)
+    self.evaluator = db.LocalDatabase(compiled=True)
+
+  def test_foreach_join_is_fused(self):
+    l1 = Operation('LOAD', self.employee_schema, path='employees.txt')
+    l2 = Operation('LOAD', self.department_schema, path='departments.txt')
+    schema_join = relation.Schema.join(
+      [self.employee_schema, self.department_schema],
+      ['Employee', 'Department'])
+    j = Operation('JOIN', schema_join, children=[l1,l2],
+                  join_attributes=[(1,4)])
+    schema_out = relation.Schema.from_strings(['name:string','dept:string'])
+    ex = Operation('FOREACH', schema_out, children=[j], column_indexes=[2,5])
+
+    # Both loads feed a single generated function
+    source, inputs = codegen.generate(ex)
+    self.assertEqual([op for op, _ in inputs], [l2, l1])
+
+    actual = self.evaluator.evaluate_to_bag(ex)
+    expected = collections.Counter([(e[2], d[1])
+                                    for e in self.employee_tuples
+                                    for d in self.department_tuples
+                                    if e[1] == d[0]])
+    self.assertEqual(actual, expected)
+
+    # Plans of the same shape share a compiled function
+    fn = codegen.compile_source(source)
+    self.assertIs(fn, codegen.compile_source(codegen.generate(ex)[0]))
+
+    # Only the most recently used functions are kept
+    saved = codegen.PIPELINE_CACHE_SIZE
+    codegen.PIPELINE_CACHE_SIZE = 1
+    try:
+      codegen.compile_source('def _pipeline(_inputs, _hash_table):\n'
+                             '    return iter(())\n')
+      self.assertEqual(len(codegen._pipeline_cache), 1)
+      self.assertIsNot(codegen.compile_source(source), fn)
+    finally:
+      codegen.PIPELINE_CACHE_SIZE = saved
+
+    # Joins planned as nested loops are interpreted
+    j = Operation('JOIN', schema_join, children=[l1,l2],
+                  join_attributes=[(1,4)], algorithm='nested_loop')
+    ex = Operation('FOREACH', schema_out, children=[j], column_indexes=[2,5])
+    self.assertEqual(codegen.generate(ex)[1], [(j, True)])
+    self.assertEqual(self.evaluator.evaluate_to_bag(ex), expected)
+
+class CompressedLocalDatabaseTests(LocalDatabaseTests):
+  '''Run the evaluator tests against compressed stored relations'''
+  def setUp(self):
+    LocalDatabaseTests.setUp(self)
+    self.evaluator = db.LocalDatabase(compressed=True)
+
+class EncodingTests(unittest.TestCase):
+  def test_columns(self):
+    columns = [
+      ('delta', range(-5, 3000, 3)),
+      ('for', [random.randint(10**9, 10**9 + 200) for k in range(500)]),
+      ('rle', ['accounting'] * 300 + ['sales'] * 200),
+      ('plain', [str(random.random()) for k in range(100)]),
+    ]
+    for kind, values in columns:
+      encoded = encoding.encode_column(values)
+      self.assertEqual(encoded[0], kind)
+      self.assertEqual(list(encoding.decode_column(encoded)), values)
+
+    for v in [0, 1, -1, 2**70, -2**70]:
+      self.assertEqual(encoding.unzigzag(encoding.zigzag(v)), v)
+
+  def test_relation(self):
+    edges = collections.Counter()
+    for k in range(5000):
+      edges[(k // 7, random.randint(0, 50000), 'edge')] += random.choice([1, 3])
+    compressed = encoding.CompressedRelation.from_pairs(edges.iteritems(),
+                                                        block_size=512)
+    self.assertEqual(len(compressed), len(edges))
+    self.assertEqual(db.to_bag(compressed.iteritems()), edges)
+    self.assertTrue(compressed.nbytes() < 5000 * 8)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'edges.myrz')
+      with open(path, 'wb') as fh:
+        compressed.dump(fh)
+      with open(path, 'rb') as fh:
+        loaded = encoding.CompressedRelation.load(fh)
+      self.assertEqual(db.to_bag(loaded.iteritems()), edges)
+    finally:
+      shutil.rmtree(tmpdir)
+
+class AdmissionTests(unittest.TestCase):
+  def test_admission(self):
+    controller = memory.AdmissionController(100, timeout=0.05)
+    self.assertRaises(memory.AdmissionRejected, controller.admit, 200)
+
+    controller.admit(60)
+    self.assertRaises(memory.AdmissionRejected, controller.admit, 60)
+
+    # Programs wait until enough memory is released
+    controller.timeout = None
+    waiter = threading.Thread(target=controller.admit, args=(60,))
+    waiter.start()
+    controller.release(60)
+    waiter.join()
+    self.assertEqual(controller.reserved, 60)
+
+  def test_estimate_footprint(self):
+    statements = [('ASSIGN', 'E', ('LOAD', 'edge.txt', None)),
+                  ('ASSIGN', 'T', ('TABLE', [(1, 2)], None))]
+    self.assertEqual(memory.estimate_footprint(statements[:1]),
+                     memory.LOAD_EXPANSION * os.path.getsize('edge.txt'))
+    self.assertTrue(memory.estimate_footprint(statements) >
+                    memory.estimate_footprint(statements[:1]))
+
+class LoaderTests(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.schema = relation.Schema.from_strings(['source:int', 'dest:int'])
+    self.expected = collections.Counter()
+    for part in range(3):
+      with open(os.path.join(self.tmpdir, 'part-%d.txt' % part), 'w') as fh:
+        fh.write('# part %d\n\n' % part)
+        for k in range(200):
+          tpl = (random.randint(0, 20), random.randint(0, 20))
+          self.expected[tpl] += 1
+          fh.write('%d\t%d\n' % tpl)
+          if k % 50 == 0:
+            fh.write('  # comment\n')
+    with open(os.path.join(self.tmpdir, '.hidden'), 'w') as fh:
+      fh.write('junk\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def load(self, path):
+    evaluator = db.LocalDatabase(load_cache=None)
+    return evaluator.evaluate_to_bag(Operation('LOAD', self.schema, path=path))
+
+  def test_split_file(self):
+    path = os.path.join(self.tmpdir, 'part-0.txt')
+    lines = open(path).readlines()
+    for chunk_bytes in [1, 7, 100, 10**6]:
+      ranges = loader.split_file(path, chunk_bytes)
+      self.assertEqual(
+        [line for r in ranges for line in loader.range_lines(*r)], lines)
+
+  def test_glob_and_directory(self):
+    self.assertEqual(self.load(self.tmpdir), self.expected)
+    self.assertEqual(self.load(os.path.join(self.tmpdir, 'part-*.txt')),
+                     self.expected)
+
+  def test_parallel_load(self):
+    saved = loader.CHUNK_BYTES, loader.PARALLEL_THRESHOLD, loader.PROCESSES
+    loader.CHUNK_BYTES, loader.PARALLEL_THRESHOLD, loader.PROCESSES = 97, 0, 2
+    try:
+      self.assertEqual(self.load(self.tmpdir), self.expected)
+
+      cache = loadcache.LoadCache()
+      evaluator = db.LocalDatabase(load_cache=cache)
+      ex = Operation('LOAD', self.schema, path=self.tmpdir)
+      self.assertEqual(evaluator.evaluate_to_bag(ex), self.expected)
+      self.assertEqual(len(cache), 1)
+    finally:
+      loader.CHUNK_BYTES, loader.PARALLEL_THRESHOLD, loader.PROCESSES = saved
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+'''Memory accounting and admission control for programs
+
+Each program may charge the memory it uses to a MemoryAccount with a
+budget.  Operators that materialize their inputs (DISTINCT, hash joins,
+REPLACE and INSERT) charge the account as their sets, bags and hash tables
+grow, and stored relations are charged while they are stored.  A program
+that exceeds its budget fails with MemoryBudgetExceeded rather than
+exhausting the memory of every program sharing the process.
+
+Sizes are estimates: containers are measured by sampling a few entries, and
+growing containers are measured every CHECK_INTERVAL items.
+
+An AdmissionController shares a fixed capacity between programs; programs
+wait until their estimated footprint fits, and are rejected with
+AdmissionRejected if it never can.
+'''
+
+import encoding
+import loader
+
+import itertools
+import os
+import sys
+import threading
+import time
+
+# Number of items added to a container between measurements of its size
+CHECK_INTERVAL = 4096
+
+# Number of entries sampled to estimate the size of a container
+SAMPLE_SIZE = 8
+
+# Ratio of the size of parsed tuples in memory to the size of their text
+LOAD_EXPANSION = 8
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+class AdmissionRejected(Exception):
+    pass
+
+def object_bytes(obj):
+    '''Estimate the bytes used by a scalar, tuple or list and its contents'''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(object_bytes(x) for x in obj)
+    return size
+
+def container_bytes(container):
+    '''Estimate the bytes used by a dict or set and its entries'''
+    size = sys.getsizeof(container)
+    if not container:
+        return size
+    if isinstance(container, dict):
+        entries = container.iteritems()
+    else:
+        entries = iter(container)
+    sample = list(itertools.islice(entries, SAMPLE_SIZE))
+    entry_size = sum(object_bytes(x) for x in sample) // len(sample)
+    return size + len(container) * entry_size
+
+def relation_bytes(chunks):
+    '''Estimate the bytes used by the chunks of a stored relation'''
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, encoding.CompressedRelation):
+            size += chunk.nbytes()
+        else:
+            size += container_bytes(chunk)
+    return size
+
+class MemoryAccount:
+    '''The memory used by one program'''
+
+    def __init__(self, name, budget=None):
+        self.name = name
+
+        # Maximum number of bytes the program may use; None is unlimited
+        self.budget = budget
+        self.used = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def charge(self, nbytes):
+        with self.lock:
+            if self.budget is not None and self.used + nbytes > self.budget:
+                raise MemoryBudgetExceeded(
+                    '%s needs %d more bytes, but has used %d of its budget '
+                    'of %d bytes' % (self.name, nbytes, self.used,
+                                     self.budget))
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes):
+        with self.lock:
+            self.used -= nbytes
+
+def collect(items, add, container, account):
+    '''Add items to a container, charging account as the container grows
+
+    add(items) adds an iterable of items to container.  Return the number of
+    bytes charged.
+    '''
+    if account is None:
+        add(items)
+        return 0
+
+    charged = 0
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, CHECK_INTERVAL))
+        if not batch:
+            return charged
+        add(batch)
+        size = container_bytes(container)
+        if size > charged:
+            try:
+                account.charge(size - charged)
+            except MemoryBudgetExceeded:
+                account.release(charged)
+                raise
+            charged = size
+
+class AdmissionController:
+    '''Admit programs while their reserved memory fits in a capacity'''
+
+    def __init__(self, capacity, timeout=None):
+        self.capacity = capacity
+
+        # Seconds a program may wait for admission; None waits forever
+        self.timeout = timeout
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def admit(self, nbytes):
+        '''Reserve memory for a program, waiting until it is available'''
+        if nbytes > self.capacity:
+            raise AdmissionRejected(
+                'Program needs %d bytes, more than the capacity of %d '
+                'bytes' % (nbytes, self.capacity))
+
+        with self.condition:
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while self.reserved + nbytes > self.capacity:
+                if self.timeout is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AdmissionRejected(
+                        'Timed out waiting for %d bytes; %d of %d bytes are '
+                        'reserved' % (nbytes, self.reserved, self.capacity))
+                self.condition.wait(remaining)
+            self.reserved += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.reserved -= nbytes
+            self.condition.notify_all()
+
+def estimate_footprint(node):
+    '''Estimate the memory needed by a parsed program from its inputs'''
+    if isinstance(node, list):
+        return sum(estimate_footprint(x) for x in node)
+    if not isinstance(node, tuple) or not node:
+        return 0
+
+    if node[0] == 'LOAD' and isinstance(node[1], str):
+        paths = [p for p in loader.expand_path(node[1]) if os.path.exists(p)]
+        return LOAD_EXPANSION * sum(os.path.getsize(p) for p in paths)
+    elif node[0] == 'TABLE' and isinstance(node[1], list):
+        return object_bytes(node[1])
+    return sum(estimate_footprint(x) for x in node)
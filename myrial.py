@@ -1,35 +1,70 @@
 #!/usr/bin/python
 
+import checkpoint
 import db
+import encoding
+import joins
+import loadcache
+import memory
 import relation
 import parser
+import planner
+import sinks
+import tracing
 
+import argparse
 import collections
+import hashlib
+import itertools
+import os
 import random
 import sys
+import time
 import types
 
+class UnboundParameterException(Exception):
+    pass
+
 class ExpressionProcessor:
     '''Convert syntactic expressions into an operation (query plan)
 
     Also, perform any required type checking.
     '''
-    def __init__(self, symbols):
+    def __init__(self, symbols, parameters={}, prepare=False):
         self.symbols = symbols
 
+        # Map from parameter names to bound values
+        self.parameters = parameters
+
+        # Whether a program is being prepared; if so, unbound parameters are
+        # left in the plan, to be bound by bind_parameters
+        self.prepare = prepare
+
     def evaluate(self, expr):
         method = getattr(self, expr[0].lower())
         return method(*expr[1:])
 
+    def resolve(self, value):
+        if not isinstance(value, parser.Parameter):
+            return value
+        if value.name in self.parameters:
+            return self.parameters[value.name]
+        if not self.prepare:
+            raise UnboundParameterException(
+                'No value is bound to parameter $%s' % value.name)
+        return value
+
     def alias(self, _id):
         return self.symbols[_id]
 
     def load(self, path, schema):
-        return db.Operation('LOAD', schema, path=path)
+        return db.Operation('LOAD', schema, path=self.resolve(path))
 
     def table(self, tuple_list, schema):
-        for tp in tuple_list:
-            schema.validate_tuple(tp)
+        tuple_list = self.resolve(tuple_list)
+        if not isinstance(tuple_list, parser.Parameter):
+            for tp in tuple_list:
+                schema.validate_tuple(tp)
         return db.Operation('TABLE', schema, tuple_list=tuple_list)
 
     def distinct(self, expr):
@@ -54,7 +89,23 @@ class ExpressionProcessor:
 
     def limit(self, _id, count):
         c_op1 = self.symbols[_id]
-        return db.Operation('LIMIT', c_op1.schema, children=[c_op1])
+        return db.Operation('LIMIT', c_op1.schema, children=[c_op1],
+                            count=count)
+
+    def sample(self, _id, count, percent):
+        '''Sample count percent of a relation, or count of its tuples'''
+        c_op = self.symbols[_id]
+        if percent:
+            return db.Operation('SAMPLE', c_op.schema, children=[c_op],
+                                fraction=count / 100.0)
+        return db.Operation('SAMPLE', c_op.schema, children=[c_op],
+                            size=count)
+
+    def approx_distinct(self, _id):
+        c_op = self.symbols[_id]
+        schema = relation.Schema.from_strings(
+            ['estimate:int', 'low:int', 'high:int'])
+        return db.Operation('APPROX_DISTINCT', schema, children=[c_op])
 
     def foreach(self, _id, column_names, rename_schema):
         c_op = self.symbols[_id]
@@ -95,45 +146,156 @@ class ExpressionProcessor:
         schema_out = relation.Schema.join([c_op1.schema, c_op2.schema],
                                           [arg1.id, arg2.id])
 
-        return db.Operation('JOIN', schema_out, children=[c_op1, c_op2],
-                            join_attributes=join_attributes)
+        op = db.Operation('JOIN', schema_out, children=[c_op1, c_op2],
+                          join_attributes=join_attributes)
+
+        # Collapse chains of joins into a single multiway join
+        if any(c.type in ('JOIN', 'MULTIJOIN') for c in op.children):
+            children, join_attributes = joins.flatten_join(op)
+            op = db.Operation('MULTIJOIN', schema_out, children=children,
+                              join_attributes=join_attributes)
+        return op
+
+    def closure(self, _id):
+        c_op = self.symbols[_id]
+        schema = c_op.schema
+        if schema.num_columns() != 2:
+            raise relation.SchemaCompatibilityException(
+                'CLOSURE requires a binary relation: %s' % str(schema))
+        relation.Schema.check_columns_compatible(schema, 0, schema, 1)
+        return db.Operation('CLOSURE', schema, children=[c_op])
 
 class StatementProcessor:
     '''Evaluate a list of statements'''
 
-    def __init__(self, out=sys.stdout, eager_evaluation=False):
+    def __init__(self, out=sys.stdout, eager_evaluation=False, compiled=False,
+                 native_closure=True, database=None, symbols={}, sink=None,
+                 compressed=False, checkpoint_dir=None,
+                 checkpoint_interval=checkpoint.DEFAULT_INTERVAL,
+                 resume=False, adaptive=True, plan_log=None,
+                 memory_budget=None, tracer=None):
         # Map from identifiers to db operation
-        self.symbols = {}
+        self.symbols = dict(symbols)
+        self.program_name = 'PROGRAM-' + str(random.randint(0,0x1000000000))
 
-        self.db = db.LocalDatabase()
+        if database is None:
+            database = db.LocalDatabase(compiled=compiled,
+                                        compressed=compressed)
+
+        # If memory_budget is set, the memory used by the program's
+        # operators and relations is limited to that many bytes
+        self.account = None
+        if memory_budget is not None:
+            self.account = memory.MemoryAccount(self.program_name,
+                                                memory_budget)
+            database = database.accounted(self.account)
+
+        # If tracer is set, it receives events for every statement, loop
+        # iteration and operator; see the tracing module
+        self.tracer = tracer
+        if tracer is not None:
+            database = database.traced(tracer)
+        self.db = database
         self.out = out
+
+        # Destination of DUMP results; if None, they are written to out
+        self.sink = sink
         self.eager_evaluation = eager_evaluation
+        self.native_closure = native_closure
         self.ep = ExpressionProcessor(self.symbols)
-        self.program_name = 'PROGRAM-' + str(random.randint(0,0x1000000000))
+
+        # Map from RelationKey to the operation that was materialized there
+        self.plans = {}
+
+        # Map from RelationKey to loop-invariant operations that were
+        # evaluated once, outside of a DO/WHILE loop
+        self.hoisted = {}
+
+        # If checkpoint_dir is set, the state of each outermost DO/WHILE
+        # loop is saved there every checkpoint_interval iterations and when
+        # the loop ends; if resume is set, loops restart from those files
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        # Number of outermost loops started, and the current loop nesting
+        self.loops = 0
+        self.loop_depth = 0
+
+        # Map from the id of each loop body to its (number, body); relations
+        # hoisted out of a loop are stored under keys named by its number,
+        # so a nested loop that runs many times reuses the same keys.
+        # Bodies are kept so that their ids are never reused.
+        self.loop_bodies = {}
+
+        # If adaptive is set, assignments in loops are planned again on
+        # every iteration using the current sizes of relations.  The sizes
+        # of the symbols assigned by each iteration of the running loop, or
+        # of the last loop to finish, are recorded in cardinalities as
+        # (iteration, {symbol : size}) pairs, and the sizes and planning
+        # decisions are written to plan_log if it is not None.
+        self.planner = None
+        if adaptive:
+            self.planner = planner.AdaptivePlanner(self.db)
+        self.plan_log = plan_log
+        self.cardinalities = []
+        self.iteration = None
 
     def evaluate(self, statements):
         for statement in statements:
             method = getattr(self, statement[0].lower())
+            if self.tracer is None:
+                method(*statement[1:])
+            else:
+                self.trace_statement(method, statement)
+
+    def trace_statement(self, method, statement):
+        symbol = None
+        if isinstance(statement[1], str):
+            symbol = statement[1]
+        self.tracer.emit('statement_start', statement=statement[0],
+                         symbol=symbol)
+        start = time.time()
+        error = None
+        try:
             method(*statement[1:])
+        except Exception, e:
+            error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            self.tracer.emit('statement_end', statement=statement[0],
+                             symbol=symbol, seconds=time.time() - start,
+                             error=error)
 
     def assign(self, _id, expr):
         op = self.ep.evaluate(expr)
 
+        if self.planner is not None and self.loop_depth > 0:
+            op, decisions = self.planner.plan(op)
+            for decision in decisions:
+                self.log_plan('%s = %s' % (_id, decision))
+
         if self.eager_evaluation and op.is_non_leaf():
-            # Transform the query into a database insertion
             key = db.RelationKey(
                 user='system', program=self.program_name, relation=_id)
-            insert = db.Operation('REPLACE', schema=None, children=[op],
-                                  relation_key=key)
-            self.db.evaluate(insert)
-
-            # Re-write the expression to be a scan of the materialized table
-            self.symbols[_id] = db.Operation('SCAN', schema=op.schema,
-                                             children=[], relation_key=key)
-
+            self.symbols[_id] = self.materialize(key, op)
         else:
             self.symbols[_id] = op
 
+    def materialize(self, key, op):
+        '''Store the result of an operation; return a scan of the result'''
+        # Transform the query into a database insertion
+        insert = db.Operation('REPLACE', schema=None, children=[op],
+                              relation_key=key)
+        self.db.evaluate(insert)
+        self.plans[key] = op
+
+        # Re-write the expression to be a scan of the materialized table
+        return db.Operation('SCAN', schema=op.schema, children=[],
+                            relation_key=key)
+
     def describe(self, _id):
         op = self.symbols[_id]
 
@@ -151,16 +313,56 @@ class StatementProcessor:
         else:
             s = '%s : %s\n' % (_id, str(op))
             self.out.write(s)
+            for key in self.hoisted_relations(op):
+                s = '  %s : loop-invariant, evaluated once: %s\n' % (
+                    key.relation, str(self.hoisted[key]))
+                self.out.write(s)
+
+    def hoisted_relations(self, op):
+        '''Return the keys of hoisted relations read by an operation
+
+        Relations are followed through the plans that materialized them, so
+        that loop-invariant work is reported for symbols assigned in a loop.
+        '''
+        found = set()
+        seen = set()
+        stack = [op]
+        while stack:
+            op = stack.pop()
+            stack.extend(op.children)
+            if op.type != 'SCAN':
+                continue
+            key = op.kwargs['relation_key']
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in self.hoisted:
+                found.add(key)
+            elif key in self.plans:
+                stack.append(self.plans[key])
+        return sorted(found)
 
     def dump(self, _id):
         op = self.symbols[_id]
         result = self.db.evaluate(op)
 
-        if type(self.out) == types.ListType:
-            self.out.append(collections.Counter(result))
+        if self.sink is not None:
+            self.sink.dump(_id, op.schema, result)
+        elif type(self.out) == types.ListType:
+            self.out.append(db.to_bag(result))
         else:
-            strs = (str(x) for x in result)
-            self.out.write('%s : [%s]\n' % (_id, ','.join(strs)))
+            # Write the relation in bounded chunks.  The first chunk is read
+            # before anything is written, so an operator that fails when
+            # its output is read leaves no partial line.
+            strs = (str(x) for x in db.elements(result))
+            chunk = list(itertools.islice(strs, sinks.DEFAULT_CHUNK_SIZE))
+            separator = ''
+            self.out.write('%s : [' % _id)
+            while chunk:
+                self.out.write(separator + ','.join(chunk))
+                separator = ','
+                chunk = list(itertools.islice(strs, sinks.DEFAULT_CHUNK_SIZE))
+            self.out.write(']\n')
 
     def dowhile(self, statement_list, termination_ex):
         # Switch to eager evaluation; lazy evaluation will screw up
@@ -168,28 +370,481 @@ class StatementProcessor:
         old_mode = self.eager_evaluation
         self.eager_evaluation = True
 
+        # Only outermost loops are checkpointed; their state includes the
+        # state of any loops nested in them
+        path = None
+        if self.loop_depth == 0:
+            if self.checkpoint_dir is not None:
+                path = checkpoint.checkpoint_path(self.checkpoint_dir,
+                                                  self.loops)
+            self.loops += 1
+        self.loop_depth += 1
+
         try:
-            while True:
-                self.evaluate(statement_list)
-                term_op = self.ep.evaluate(termination_ex)
-                result = self.db.evaluate(term_op)
-                result.next() # check for non-emptiness
-        except StopIteration:
-            pass
+            loop = self.loop_number(statement_list)
+            if self.native_closure:
+                match = match_closure_loop(statement_list, termination_ex,
+                                           self.symbols)
+                if match:
+                    self.closure_loop(statement_list, loop, *match)
+                    return
+
+            # Native closures are not checkpointed, so the inputs are only
+            # read for a fingerprint once the loop is known to run here
+            fingerprint = None
+            if path is not None:
+                fingerprint = self.loop_fingerprint(statement_list,
+                                                    termination_ex)
+            statement_list = self.hoist_invariants(statement_list,
+                                                   termination_ex, loop)
+            self.run_loop(statement_list, termination_ex, path, fingerprint)
         finally:
+            self.loop_depth -= 1
             self.eager_evaluation = old_mode
 
-def evaluate(s, out=sys.stdout, eager_evaluation=False):
+    def run_loop(self, statement_list, termination_ex, path=None,
+                 fingerprint=None):
+        '''Run a loop body until the termination expression is empty
+
+        If path is not None, the loop is checkpointed to that file, and
+        fingerprint identifies the loop and its inputs.
+        '''
+        outer_iteration = self.iteration
+        outer_cardinalities = self.cardinalities
+        self.cardinalities = []
+        try:
+            self.__run_loop(statement_list, termination_ex, path,
+                            fingerprint)
+        finally:
+            self.iteration = outer_iteration
+            if self.loop_depth > 1:
+                self.cardinalities = outer_cardinalities
+
+    def __run_loop(self, statement_list, termination_ex, path, fingerprint):
+        assigned = tuple(sorted(assigned_symbols(statement_list)))
+        iteration = 0
+
+        if path is not None and self.resume:
+            saved = checkpoint.read_checkpoint(path)
+            if saved is not None:
+                self.restore_checkpoint(saved, fingerprint)
+                if saved.done:
+                    return
+                iteration = saved.iteration
+
+        while True:
+            iteration += 1
+            self.iteration = iteration
+            start = time.time()
+            self.evaluate(statement_list)
+            if self.planner is not None:
+                self.record_cardinalities(assigned)
+            if self.tracer is not None:
+                sizes = {}
+                if self.cardinalities:
+                    sizes = self.cardinalities[-1][1]
+                self.tracer.emit('loop_iteration', iteration=iteration,
+                                 seconds=time.time() - start, sizes=sizes)
+
+            term_op = self.ep.evaluate(termination_ex)
+            result = self.db.evaluate(term_op)
+            try:
+                result.next() # check for non-emptiness
+            except StopIteration:
+                break
+
+            if path is not None and iteration % self.checkpoint_interval == 0:
+                self.save_checkpoint(path, fingerprint, assigned, iteration,
+                                     False)
+
+        if path is not None:
+            self.save_checkpoint(path, fingerprint, assigned, iteration, True)
+
+    def record_cardinalities(self, symbols):
+        '''Record the sizes of the relations bound to symbols'''
+        sizes = {}
+        for _id in symbols:
+            op = self.symbols[_id]
+            if op.type == 'SCAN':
+                sizes[_id] = self.db.cardinality(op.kwargs['relation_key'])
+        self.cardinalities.append((self.iteration, sizes))
+        self.log_plan(', '.join('%s=%d' % (_id, sizes[_id])
+                                for _id in sorted(sizes)))
+
+    def log_plan(self, message):
+        if self.plan_log is not None:
+            self.plan_log.write('iteration %d: %s\n' % (self.iteration,
+                                                        message))
+
+    def loop_fingerprint(self, statement_list, termination_ex):
+        '''Return a string identifying a loop and the relations it reads
+
+        The fingerprint covers the parsed loop body and the schema and
+        contents of each relation the loop reads when it starts, so a
+        checkpoint is not resumed by a changed program or on changed inputs.
+        '''
+        digest = hashlib.sha1()
+        digest.update(repr(statement_list))
+        digest.update(repr(termination_ex))
+
+        reads = statement_references(statement_list)
+        reads |= expression_references(termination_ex)
+        for _id in sorted(reads):
+            if _id not in self.symbols:
+                continue
+            op = self.symbols[_id]
+            digest.update(repr((_id, str(op.schema))))
+            bag = self.db.evaluate_to_bag(op)
+            for pair in sorted(bag.iteritems()):
+                digest.update(repr(pair))
+        return digest.hexdigest()
+
+    def save_checkpoint(self, path, fingerprint, symbols, iteration, done):
+        '''Write the relations bound to a loop's symbols to a file'''
+        relations = []
+        for _id in symbols:
+            op = self.symbols[_id]
+            bag = self.db.evaluate_to_bag(op)
+            relations.append((_id, op.schema,
+                              encoding.CompressedRelation.from_pairs(
+                                  bag.iteritems())))
+        checkpoint.write_checkpoint(
+            path, checkpoint.Checkpoint(fingerprint, iteration, done,
+                                        relations))
+
+    def restore_checkpoint(self, saved, fingerprint):
+        '''Bind a loop's symbols to the relations in a checkpoint'''
+        if saved.fingerprint != fingerprint:
+            raise checkpoint.CheckpointException(
+                'Checkpoint is for a different loop or different inputs')
+
+        for _id, schema, compressed in saved.relations:
+            if (_id in self.symbols and
+                str(schema) != str(self.symbols[_id].schema)):
+                raise checkpoint.CheckpointException(
+                    'Checkpoint has schema %s for %s, not %s' % (
+                        schema, _id, self.symbols[_id].schema))
+
+        for _id, schema, compressed in saved.relations:
+            key = db.RelationKey(user='system', program=self.program_name,
+                                 relation='%s.checkpoint.%d' % (
+                                     _id, saved.iteration))
+            self.db.put(key, db.to_bag(compressed.iteritems()), schema)
+            self.symbols[_id] = db.Operation('SCAN', schema=schema,
+                                             children=[], relation_key=key)
+
+    def loop_number(self, statement_list):
+        '''Return the number identifying a loop body'''
+        entry = self.loop_bodies.get(id(statement_list))
+        if entry is None:
+            entry = (len(self.loop_bodies), statement_list)
+            self.loop_bodies[id(statement_list)] = entry
+        return entry[0]
+
+    def hoist_invariants(self, statement_list, termination_ex, loop):
+        '''Evaluate the loop-invariant parts of a loop body once
+
+        Relations that are read but never assigned by the loop are
+        materialized, as are assignments that only read such relations.
+        Return the statements that must still run on every iteration.
+        '''
+        assignments = assigned_symbols(statement_list)
+        reads = statement_references(statement_list)
+        reads |= expression_references(termination_ex)
+
+        for _id in sorted(reads):
+            if _id in assignments or _id not in self.symbols:
+                continue
+            self.symbols[_id] = self.hoist(_id, self.symbols[_id], loop)
+
+        invariant = set()
+        body = []
+        read = set()
+        for statement in statement_list:
+            if statement[0] == 'ASSIGN':
+                _id, expr = statement[1:]
+                refs = expression_references(expr)
+                if (assignments[_id] == 1 and _id not in read and
+                    all(r in invariant or r not in assignments for r in refs)):
+                    self.symbols[_id] = self.hoist(
+                        _id, self.ep.evaluate(expr), loop)
+                    invariant.add(_id)
+                    read |= refs
+                    continue
+            body.append(statement)
+            read |= statement_references([statement])
+        return body
+
+    def closure_loop(self, statement_list, loop, reachable_id, edge_id):
+        '''Evaluate a reachability loop with the native CLOSURE operator'''
+        reachable = self.symbols[reachable_id]
+        op = db.Operation('CLOSURE', reachable.schema,
+                          children=[reachable, self.symbols[edge_id]])
+        key = db.RelationKey(user='system', program=self.program_name,
+                             relation='%s.closure.%d' % (reachable_id, loop))
+        self.symbols[reachable_id] = self.materialize(key, op)
+
+        # Bind the loop's temporaries to their values at the fixpoint; they
+        # are evaluated only if the program reads them
+        for _, _id, expr in statement_list[:-1]:
+            self.symbols[_id] = self.ep.evaluate(expr)
+
+    def hoist(self, _id, op, loop):
+        '''Materialize a loop-invariant operation of a loop
+
+        Each time a loop is entered, its invariants replace the relations
+        hoisted the last time it ran.
+        '''
+        if op.type in ('SCAN', 'TABLE'):
+            return op
+
+        key = db.RelationKey(user='system', program=self.program_name,
+                             relation='%s.invariant.%d' % (_id, loop))
+        self.hoisted[key] = op
+        return self.materialize(key, op)
+
+class PreparedProgram:
+    '''A program that is parsed and planned once and executed many times
+
+    Statements before the first DO/WHILE loop are planned, and type checked,
+    when the program is prepared.  Loops depend on values computed at run
+    time, so they and the statements after them are planned as they
+    execute.
+    '''
+
+    def __init__(self, statement_list, compiled=False):
+        self.compiled = compiled
+        self.parameters = find_parameters(statement_list)
+
+        # Planned statements; assignments hold the operation to bind
+        self.steps = []
+        self.remainder = []
+
+        symbols = {}
+        ep = ExpressionProcessor(symbols, prepare=True)
+        for i, statement in enumerate(statement_list):
+            if statement[0] == 'DOWHILE':
+                self.remainder = statement_list[i:]
+                break
+            elif statement[0] == 'ASSIGN':
+                op = ep.evaluate(statement[2])
+                symbols[statement[1]] = op
+                self.steps.append(('ASSIGN', statement[1], op))
+            else:
+                self.steps.append(statement)
+
+    def execute(self, parameters={}, out=sys.stdout, database=None,
+                sink=None):
+        '''Run the program with values bound to its parameters'''
+        missing = self.parameters - set(parameters)
+        if missing:
+            raise UnboundParameterException(', '.join(sorted(missing)))
+
+        processor = StatementProcessor(out, compiled=self.compiled,
+                                       database=database, sink=sink)
+        processor.ep.parameters = parameters
+
+        bound = {}
+        for step in self.steps:
+            if step[0] == 'ASSIGN':
+                processor.symbols[step[1]] = bind_parameters(
+                    step[2], parameters, bound)
+            else:
+                processor.evaluate([step])
+        processor.evaluate(self.remainder)
+
+def find_parameters(node):
+    '''Return the names of the parameters in parsed statements'''
+    if isinstance(node, parser.Parameter):
+        return set([node.name])
+    names = set()
+    if isinstance(node, (tuple, list)):
+        for child in node:
+            names |= find_parameters(child)
+    return names
+
+def bind_parameters(op, parameters, memo):
+    '''Return an operation with its parameters replaced by bound values
+
+    Operations without parameters are returned as is; memo maps the ids of
+    operations to their bound copies, so shared subplans stay shared.
+    '''
+    if id(op) in memo:
+        return memo[id(op)]
+
+    children = [bind_parameters(c, parameters, memo) for c in op.children]
+    changed = any(c is not d for c, d in zip(children, op.children))
+    kwargs = dict(op.kwargs)
+    for name, value in kwargs.items():
+        if isinstance(value, parser.Parameter):
+            kwargs[name] = parameters[value.name]
+            changed = True
+
+    if changed:
+        if op.type == 'TABLE':
+            for tp in kwargs['tuple_list']:
+                op.schema.validate_tuple(tp)
+        result = db.Operation(op.type, op.schema, children=children, **kwargs)
+    else:
+        result = op
+    memo[id(op)] = result
+    return result
+
+def match_closure_loop(statement_list, termination_ex, symbols):
+    '''Recognize the reachability loop of reachable.myl
+
+    The loop must have the form:
+
+      A = JOIN R BY dest, E BY source;
+      N = DISTINCT FOREACH A EMIT (R.source, E.dest);
+      D = DIFF N, R;
+      R = UNION D, R;
+    WHILE D;
+
+    where R and E are binary relations with columns of a single type, and
+    the FOREACH renames its output to the columns of R.  Return
+    the pair (R, E) of identifiers, or None if the loop does not match.
+    '''
+    if len(statement_list) != 4:
+        return None
+    if any(statement[0] != 'ASSIGN' for statement in statement_list):
+        return None
+    (_, a, join), (_, n, distinct), (_, d, diff), (_, r, union) = \
+        statement_list
+
+    if join[0] != 'JOIN' or distinct[0] != 'DISTINCT':
+        return None
+    target1, target2 = join[1:]
+    e = target2.id
+    if len(set([a, n, d, r, e])) != 5 or target1.id != r:
+        return None
+    if r not in symbols or e not in symbols:
+        return None
+
+    schema_r = symbols[r].schema
+    schema_e = symbols[e].schema
+    if schema_r.num_columns() != 2 or schema_e.num_columns() != 2:
+        return None
+    names_r = [c.name for c in schema_r.columns]
+    names_e = [c.name for c in schema_e.columns]
+    if target1.column_names != (names_r[1],):
+        return None
+    if target2.column_names != (names_e[0],):
+        return None
+    if len(set(c.type for c in schema_r.columns + schema_e.columns)) != 1:
+        return None
+
+    foreach = distinct[1]
+    if foreach[:3] != ('FOREACH', a, (r + '.' + names_r[0],
+                                      e + '.' + names_e[1])):
+        return None
+
+    # The new pairs must be renamed to the columns of R, so that R keeps
+    # its schema across iterations
+    rename_schema = foreach[3]
+    if rename_schema is None:
+        return None
+    if ([(c.name, c.type) for c in rename_schema.columns] !=
+        [(c.name, c.type) for c in schema_r.columns]):
+        return None
+
+    if diff != ('DIFF', n, r):
+        return None
+    if union not in [('UNION', d, r), ('UNION', r, d)]:
+        return None
+    if termination_ex != ('ALIAS', d):
+        return None
+    return r, e
+
+def expression_references(expr):
+    '''Return the set of identifiers read by an expression'''
+    _type = expr[0]
+    if _type in ('LOAD', 'TABLE'):
+        return set()
+    elif _type == 'DISTINCT':
+        return expression_references(expr[1])
+    elif _type == 'JOIN':
+        return set([expr[1].id, expr[2].id])
+    elif _type in ('UNION', 'INTERSECT', 'DIFF'):
+        return set(expr[1:3])
+    else:
+        return set([expr[1]])
+
+def statement_references(statement_list):
+    '''Return the set of identifiers read by a list of statements'''
+    refs = set()
+    for statement in statement_list:
+        if statement[0] == 'ASSIGN':
+            refs |= expression_references(statement[2])
+        elif statement[0] == 'DOWHILE':
+            refs |= statement_references(statement[1])
+            refs |= expression_references(statement[2])
+        else:
+            refs.add(statement[1])
+    return refs
+
+def assigned_symbols(statement_list):
+    '''Count the assignments to each identifier in a list of statements'''
+    counts = collections.Counter()
+    for statement in statement_list:
+        if statement[0] == 'ASSIGN':
+            counts[statement[1]] += 1
+        elif statement[0] == 'DOWHILE':
+            counts.update(assigned_symbols(statement[1]))
+    return counts
+
+def evaluate(s, out=sys.stdout, eager_evaluation=False, compiled=False,
+             sink=None, compressed=False, checkpoint_dir=None, resume=False,
+             tracer=None):
     _parser = parser.Parser()
-    processor = StatementProcessor(out, eager_evaluation)
+    database = db.LocalDatabase(compiled=compiled,
+                                load_cache=loadcache.shared,
+                                compressed=compressed)
+    processor = StatementProcessor(out, eager_evaluation, compiled,
+                                   database=database, sink=sink,
+                                   compressed=compressed,
+                                   checkpoint_dir=checkpoint_dir,
+                                   resume=resume, tracer=tracer)
 
     statement_list = _parser.parse(s)
     processor.evaluate(statement_list)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print 'No input file provided'
-        sys.exit(1)
+def prepare(s, compiled=False):
+    '''Parse and plan a program for repeated execution'''
+    _parser = parser.Parser()
+    return PreparedProgram(_parser.parse(s), compiled)
 
-    with open(sys.argv[1]) as fh:
-        evaluate(fh.read())
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Run a myrial program')
+    argparser.add_argument('program')
+    argparser.add_argument('--compiled', action='store_true',
+                           help='compile pipelines of operators into python')
+    argparser.add_argument('--compressed', action='store_true',
+                           help='store relations in compressed blocks')
+    argparser.add_argument('--checkpoint-dir',
+                           help='directory in which to checkpoint loops')
+    argparser.add_argument('--resume', action='store_true',
+                           help='resume loops from their checkpoints')
+    argparser.add_argument('--trace-log',
+                           help='file in which to log trace events as JSON')
+    argparser.add_argument('--latencies', action='store_true',
+                           help='print latency histograms to stderr')
+    args = argparser.parse_args()
+
+    trace_sinks = []
+    if args.trace_log is not None:
+        trace_sinks.append(tracing.JsonLogSink(open(args.trace_log, 'w')))
+    if args.latencies:
+        trace_sinks.append(tracing.LatencyHistogramSink())
+    tracer = None
+    if trace_sinks:
+        tracer = tracing.Tracer(trace_sinks)
+
+    with open(args.program) as fh:
+        evaluate(fh.read(), compiled=args.compiled,
+                 compressed=args.compressed,
+                 checkpoint_dir=args.checkpoint_dir, resume=args.resume,
+                 tracer=tracer)
+
+    if args.latencies:
+        print >> sys.stderr, trace_sinks[-1].summary()
@@ -10,6 +10,9 @@ import sys
 
 JoinTarget = collections.namedtuple('JoinTarget',['id', 'column_names'])
 
+# A placeholder for a value that is bound when a prepared program executes
+Parameter = collections.namedtuple('Parameter', ['name'])
+
 class JoinColumnCountMismatchException(Exception):
     pass
 
@@ -17,6 +20,7 @@ class Parser:
     def __init__(self, log=yacc.PlyLogger(sys.stderr)):
         self.log = log
         self.tokens = scanner.tokens
+        self.parser = None
 
     def p_statement_list(self, p):
         '''statement_list : statement_list statement
@@ -54,6 +58,18 @@ class Parser:
         'expression : LOAD STRING_LITERAL AS schema'
         p[0] = ('LOAD', p[2], p[4])
 
+    def p_expression_load_parameter(self, p):
+        'expression : LOAD parameter AS schema'
+        p[0] = ('LOAD', p[2], p[4])
+
+    def p_expression_table_parameter(self, p):
+        'expression : TABLE parameter AS schema'
+        p[0] = ('TABLE', p[2], p[4])
+
+    def p_parameter(self, p):
+        'parameter : DOLLAR ID'
+        p[0] = Parameter(p[2])
+
     def p_expression_table(self, p):
         'expression : TABLE LBRACKET tuple_list RBRACKET AS schema'
         schema = p[6]
@@ -67,10 +83,26 @@ class Parser:
         'expression : LIMIT ID COMMA INTEGER_LITERAL'
         p[0] = ('LIMIT', p[2], p[4])
 
+    def p_expression_sample(self, p):
+        'expression : SAMPLE ID COMMA INTEGER_LITERAL'
+        p[0] = ('SAMPLE', p[2], p[4], False)
+
+    def p_expression_sample_percent(self, p):
+        'expression : SAMPLE ID COMMA INTEGER_LITERAL MOD'
+        p[0] = ('SAMPLE', p[2], p[4], True)
+
+    def p_expression_approx_distinct(self, p):
+        'expression : APPROX DISTINCT ID'
+        p[0] = ('APPROX_DISTINCT', p[3])
+
     def p_expression_distinct(self, p):
         'expression : DISTINCT expression'
         p[0] = ('DISTINCT', p[2])
 
+    def p_expression_closure(self, p):
+        'expression : CLOSURE ID'
+        p[0] = ('CLOSURE', p[2])
+
     def p_expression_binary_set_operation(self, p):
         'expression : setop ID COMMA ID'
         p[0] = (p[1], p[2], p[4])
@@ -175,9 +207,17 @@ class Parser:
                      | INT'''
         p[0] = p[1]
 
+    def build(self):
+        '''Build the parse tables, if they have not been built already'''
+        if self.parser is None:
+            self.parser = yacc.yacc(module=self, debug=True)
+
     def parse(self, s):
-        parser = yacc.yacc(module=self, debug=True)
-        return parser.parse(s, lexer=scanner.lexer, tracking=True)
+        # Each parse gets its own lexer state
+        self.build()
+        lexer = scanner.lexer.clone()
+        lexer.lineno = 1
+        return self.parser.parse(s, lexer=lexer, tracking=True)
 
     def p_error(self, p):
         self.log.error("Syntax error: %s" %  str(p))
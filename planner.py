@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+'''Adaptive planning of joins inside DO/WHILE loops
+
+The sizes of the relations a loop reads change from one iteration to the
+next: in a reachability loop the frontier shrinks while the reachable set
+grows.  Loop bodies are planned again on every iteration, so the planner
+chooses each JOIN's algorithm and build side from the current sizes of its
+inputs rather than fixing them when the program starts.
+
+Sizes of stored relations are read from the database; the sizes of other
+operations are estimated from their inputs.
+'''
+
+import codegen
+import db
+
+import math
+
+# Joins whose inputs have a product of at most this many tuples use a
+# nested loop, which avoids building a hash table
+NESTED_LOOP_LIMIT = 64
+
+class AdaptivePlanner:
+    def __init__(self, database):
+        self.db = database
+
+    def estimate(self, op):
+        '''Estimate the number of distinct tuples produced by an operation
+
+        Return None if the size is unknown.
+        '''
+        if op.type == 'SCAN':
+            return self.db.cardinality(op.kwargs['relation_key'])
+        elif op.type == 'TABLE':
+            return len(op.kwargs['tuple_list'])
+        elif op.type == 'LOAD':
+            return None
+
+        sizes = [self.estimate(c) for c in op.children]
+        if None in sizes:
+            return None
+        if op.type == 'UNION':
+            return sum(sizes)
+        elif op.type == 'INTERSECT':
+            return min(sizes)
+        elif op.type in ('JOIN', 'MULTIJOIN', 'CLOSURE'):
+            return max(sizes)
+        elif op.type == 'LIMIT':
+            return min(sizes[0], op.kwargs['count'])
+        elif op.type == 'SAMPLE':
+            if op.kwargs.get('fraction') is not None:
+                return int(math.ceil(sizes[0] * op.kwargs['fraction']))
+            return min(sizes[0], op.kwargs['size'])
+        elif op.type == 'APPROX_DISTINCT':
+            return 1
+        return sizes[0]
+
+    def plan(self, op):
+        '''Choose strategies for the joins in an operation
+
+        Return the planned operation and a list of strings describing the
+        choices made.
+        '''
+        decisions = []
+        return self.__plan(op, decisions, {}), decisions
+
+    def __plan(self, op, decisions, memo):
+        if id(op) in memo:
+            return memo[id(op)]
+
+        children = [self.__plan(c, decisions, memo) for c in op.children]
+        kwargs = dict(op.kwargs)
+        changed = any(c is not d for c, d in zip(children, op.children))
+        if op.type == 'JOIN' and codegen.hashable_join(op):
+            choice = self.choose_join(children, decisions)
+            if choice is not None:
+                kwargs.update(choice)
+                changed = True
+
+        if changed:
+            result = db.Operation(op.type, op.schema, children=children,
+                                  **kwargs)
+        else:
+            result = op
+        memo[id(op)] = result
+        return result
+
+    def choose_join(self, children, decisions):
+        '''Return the algorithm and build side of a join of two inputs'''
+        left, right = [self.estimate(c) for c in children]
+        if left is None or right is None:
+            return None
+
+        if left * right <= NESTED_LOOP_LIMIT:
+            decisions.append('JOIN: nested loop (%d x %d rows)' % (
+                left, right))
+            return {'algorithm' : 'nested_loop'}
+
+        build = 0 if left < right else 1
+        decisions.append('JOIN: hash join, build %s (%d rows), probe %s '
+                         '(%d rows)' % (['left', 'right'][build],
+                                        [left, right][build],
+                                        ['left', 'right'][1 - build],
+                                        [left, right][1 - build]))
+        return {'algorithm' : 'hash', 'build' : build}
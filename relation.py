@@ -67,6 +67,9 @@ class Schema:
         cstrs = [str(c) for c in self.columns]
         return '(%s)' % ','.join(cstrs)
 
+    def __repr__(self):
+        return 'Schema.from_strings(%r)' % [str(c) for c in self.columns]
+
     def __eq__(self, other):
         return self.columns == other.columns
 
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+'''A long-running myrial query server
+
+The server keeps parsers, loaded inputs and a catalog of relations warm
+between programs, so clients do not pay interpreter and parser startup costs
+on every run.  Clients connect over a TCP or Unix socket, send the text of a
+program and close their side of the connection; the server runs the program
+on a pool of worker threads and streams the output of each statement back as
+it is produced.
+
+The catalog is an optional program run once at startup; the relations it
+assigns are visible to every program the server runs.
+
+A server may be given a memory capacity, which programs share, and a memory
+budget for each program.  Programs wait for admission until their budget,
+or their estimated footprint if there is no budget, fits in the capacity.
+'''
+
+import db
+import loadcache
+import loader
+import memory
+import myrial
+import parser
+
+import argparse
+import os
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+
+class PoolMixIn:
+    '''Handle requests on a fixed pool of worker threads'''
+
+    workers = 4
+
+    def start_workers(self):
+        self.requests = Queue.Queue()
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_request_worker)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_worker(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+class ProgramHandler(SocketServer.StreamRequestHandler):
+    '''Run one program and stream its output back to the client'''
+
+    def handle(self):
+        program = self.rfile.read()
+        self.server.run(program, self.wfile)
+
+class MyrialServerMixIn(PoolMixIn):
+    def setup_catalog(self, catalog, workers, memory_capacity=None,
+                      program_budget=None, admission_timeout=None):
+        self.workers = workers
+
+        # Fork the processes that parse large inputs before any worker
+        # thread starts
+        if loader.PROCESSES > 1:
+            loader.get_pool()
+
+        self.database = db.LocalDatabase(load_cache=loadcache.shared)
+        self.program_budget = program_budget
+        self.admission = None
+        if memory_capacity is not None:
+            self.admission = memory.AdmissionController(memory_capacity,
+                                                        admission_timeout)
+        self.parsers = threading.local()
+        self.parser_lock = threading.Lock()
+
+        # Relations assigned by the catalog program are shared by all
+        # programs; they are materialized so they are only computed once
+        self.symbols = {}
+        if catalog is not None:
+            processor = myrial.StatementProcessor(
+                sys.stderr, eager_evaluation=True, database=self.database)
+            processor.evaluate(self.parser().parse(catalog))
+            self.symbols = processor.symbols
+
+        self.start_workers()
+
+    def parser(self):
+        '''Return this thread's parser, building its tables on first use'''
+        if not hasattr(self.parsers, 'parser'):
+            # Building tables writes files, so only one thread may do it
+            with self.parser_lock:
+                self.parsers.parser = parser.Parser()
+                self.parsers.parser.build()
+        return self.parsers.parser
+
+    def run(self, program, out):
+        processor = myrial.StatementProcessor(
+            out, database=self.database, symbols=self.symbols,
+            memory_budget=self.program_budget)
+        try:
+            statements = self.parser().parse(program)
+            reserved = self.admit(statements)
+            try:
+                processor.evaluate(statements)
+            finally:
+                if reserved is not None:
+                    self.admission.release(reserved)
+        except (memory.MemoryBudgetExceeded, memory.AdmissionRejected), e:
+            out.write('ERROR: %s\n' % e)
+        except Exception:
+            out.write('ERROR: %s' % traceback.format_exc())
+        finally:
+            self.database.drop_program(processor.program_name)
+
+    def admit(self, statements):
+        '''Reserve memory for a program, waiting until it is available
+
+        Return the number of bytes reserved, or None if admission is not
+        controlled.
+        '''
+        estimate = memory.estimate_footprint(statements)
+        if self.program_budget is not None and estimate > self.program_budget:
+            raise memory.MemoryBudgetExceeded(
+                'Program needs an estimated %d bytes, more than its budget '
+                'of %d bytes' % (estimate, self.program_budget))
+        if self.admission is None:
+            return None
+
+        reserved = estimate
+        if self.program_budget is not None:
+            reserved = self.program_budget
+        self.admission.admit(reserved)
+        return reserved
+
+class TcpMyrialServer(MyrialServerMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+class UnixMyrialServer(MyrialServerMixIn, SocketServer.UnixStreamServer):
+    pass
+
+def make_server(address, catalog=None, workers=4, memory_capacity=None,
+                program_budget=None, admission_timeout=None):
+    '''Create a server listening on a (host, port) pair or a socket path'''
+    if isinstance(address, tuple):
+        server = TcpMyrialServer(address, ProgramHandler)
+    else:
+        server = UnixMyrialServer(address, ProgramHandler)
+    server.setup_catalog(catalog, workers, memory_capacity, program_budget,
+                         admission_timeout)
+    return server
+
+def submit(address, program):
+    '''Run a program on a server; return an iterator over output lines'''
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    sock.sendall(program)
+    sock.shutdown(socket.SHUT_WR)
+
+    fh = sock.makefile('r')
+    sock.close()
+    return read_lines(fh)
+
+def read_lines(fh):
+    try:
+        for line in fh:
+            yield line
+    finally:
+        fh.close()
+
+def parse_address(args):
+    if args.socket is not None:
+        return args.socket
+    return (args.host, args.port)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--socket', help='path of a Unix socket')
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('--port', type=int, default=7133)
+    subparsers = argparser.add_subparsers(dest='command')
+
+    serve = subparsers.add_parser('serve', help='run the server')
+    serve.add_argument('--catalog', help='program defining shared relations')
+    serve.add_argument('--workers', type=int, default=4)
+    serve.add_argument('--memory-capacity', type=int,
+                       help='bytes of memory shared by running programs')
+    serve.add_argument('--program-budget', type=int,
+                       help='bytes of memory each program may use')
+    serve.add_argument('--admission-timeout', type=float,
+                       help='seconds a program may wait for memory')
+
+    run = subparsers.add_parser('submit', help='run a program on a server')
+    run.add_argument('program')
+
+    args = argparser.parse_args()
+    address = parse_address(args)
+
+    if args.command == 'serve':
+        catalog = None
+        if args.catalog is not None:
+            with open(args.catalog) as fh:
+                catalog = fh.read()
+        server = make_server(address, catalog, args.workers,
+                             args.memory_capacity, args.program_budget,
+                             args.admission_timeout)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if args.socket is not None:
+                os.unlink(args.socket)
+    else:
+        with open(args.program) as fh:
+            for line in submit(address, fh.read()):
+                sys.stdout.write(line)
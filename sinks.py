@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+'''Streaming destinations for the results of DUMP statements
+
+A sink receives a relation as a stream of (tuple, multiplicity) pairs and
+writes it in chunks of at most chunk_size pairs, so dumping a relation never
+buffers more than one chunk of it in memory.
+'''
+
+import relation
+
+import csv
+import Queue
+import struct
+
+DEFAULT_CHUNK_SIZE = 4096
+
+class Sink:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def dump(self, _id, schema, pairs):
+        '''Write the (tuple, multiplicity) pairs of a relation'''
+        self.begin(_id, schema)
+        chunk = []
+        for pair in pairs:
+            chunk.append(pair)
+            if len(chunk) >= self.chunk_size:
+                self.write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.write_chunk(chunk)
+        self.end()
+
+    def begin(self, _id, schema):
+        pass
+
+    def write_chunk(self, pairs):
+        raise NotImplementedError()
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+class TabDelimitedSink(Sink):
+    '''Write one tab-delimited line per tuple, in the format read by LOAD
+
+    Each relation is preceded by a comment line naming it.
+    '''
+    def __init__(self, fh, chunk_size=DEFAULT_CHUNK_SIZE):
+        Sink.__init__(self, chunk_size)
+        self.fh = fh
+
+    def begin(self, _id, schema):
+        self.fh.write('# %s : %s\n' % (_id, str(schema)))
+
+    def write_chunk(self, pairs):
+        for tpl, count in pairs:
+            line = '\t'.join(str(x) for x in tpl) + '\n'
+            for k in xrange(count):
+                self.fh.write(line)
+
+class CsvSink(Sink):
+    '''Write each relation as a header row followed by one row per tuple'''
+    def __init__(self, fh, chunk_size=DEFAULT_CHUNK_SIZE, **fmtparams):
+        Sink.__init__(self, chunk_size)
+        self.writer = csv.writer(fh, **fmtparams)
+
+    def begin(self, _id, schema):
+        self.writer.writerow([c.name for c in schema.columns])
+
+    def write_chunk(self, pairs):
+        for tpl, count in pairs:
+            for k in xrange(count):
+                self.writer.writerow(tpl)
+
+class CallbackSink(Sink):
+    '''Pass each chunk of pairs to callback(_id, schema, pairs)'''
+    def __init__(self, callback, chunk_size=DEFAULT_CHUNK_SIZE):
+        Sink.__init__(self, chunk_size)
+        self.callback = callback
+
+    def begin(self, _id, schema):
+        self._id = _id
+        self.schema = schema
+
+    def write_chunk(self, pairs):
+        self.callback(self._id, self.schema, pairs)
+
+class IteratorSink(CallbackSink):
+    '''Hand chunks of pairs to a consumer running in another thread
+
+    Iterating the sink yields (_id, tuple, multiplicity) triples.  At most
+    max_chunks chunks are queued; the program blocks until the consumer
+    catches up.  The producer must call close() when it is done.
+    '''
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=4):
+        CallbackSink.__init__(self, self.put, chunk_size)
+        self.queue = Queue.Queue(max_chunks)
+
+    def put(self, _id, schema, pairs):
+        self.queue.put((_id, pairs))
+
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            _id, pairs = item
+            for tpl, count in pairs:
+                yield _id, tpl, count
+
+# Binary columnar format: a file is a magic string followed by relations.
+# A relation is a RELATION record holding its name and schema, any number of
+# CHUNK records and an END record.  A chunk holds a row count, then each
+# column in turn, then the multiplicities.  Integers are little-endian
+# signed 64-bit values; strings are a column of 32-bit lengths followed by
+# their concatenated bytes.
+COLUMNAR_MAGIC = 'MYRC\x01'
+RELATION, CHUNK, END = 'R', 'C', 'E'
+
+def _write_array(fh, typecode, values):
+    fh.write(struct.pack('<%d%s' % (len(values), typecode), *values))
+
+def _read_array(fh, typecode, n):
+    fmt = '<%d%s' % (n, typecode)
+    return struct.unpack(fmt, fh.read(struct.calcsize(fmt)))
+
+def _write_string(fh, s):
+    fh.write(struct.pack('<I', len(s)))
+    fh.write(s)
+
+def _read_string(fh):
+    n, = struct.unpack('<I', fh.read(4))
+    return fh.read(n)
+
+class ColumnarSink(Sink):
+    '''Write relations in a binary columnar format
+
+    Multiplicities are stored as a column, so duplicated tuples are never
+    expanded.  Use read_columnar to read the file back.
+    '''
+    def __init__(self, fh, chunk_size=DEFAULT_CHUNK_SIZE):
+        Sink.__init__(self, chunk_size)
+        self.fh = fh
+        self.fh.write(COLUMNAR_MAGIC)
+
+    def begin(self, _id, schema):
+        self.schema = schema
+        self.fh.write(RELATION)
+        _write_string(self.fh, _id)
+        _write_string(self.fh, ','.join(str(c) for c in schema.columns))
+
+    def write_chunk(self, pairs):
+        self.fh.write(CHUNK)
+        self.fh.write(struct.pack('<I', len(pairs)))
+        for i, column in enumerate(self.schema.columns):
+            values = [tpl[i] for tpl, _ in pairs]
+            if column.type == 'int':
+                _write_array(self.fh, 'q', values)
+            else:
+                _write_array(self.fh, 'I', [len(v) for v in values])
+                self.fh.write(''.join(values))
+        _write_array(self.fh, 'q', [count for _, count in pairs])
+
+    def end(self):
+        self.fh.write(END)
+
+def read_columnar(fh):
+    '''Read a file written by ColumnarSink
+
+    Yield (_id, schema, pairs) triples, one for each chunk of each
+    relation, where pairs is a list of (tuple, multiplicity) pairs.
+    '''
+    if fh.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise IOError('Not a columnar myrial file')
+
+    while True:
+        record = fh.read(1)
+        if not record:
+            return
+        elif record == RELATION:
+            _id = _read_string(fh)
+            schema = relation.Schema.from_strings(_read_string(fh).split(','))
+        elif record == CHUNK:
+            n, = struct.unpack('<I', fh.read(4))
+            columns = []
+            for column in schema.columns:
+                if column.type == 'int':
+                    columns.append(_read_array(fh, 'q', n))
+                else:
+                    lengths = _read_array(fh, 'I', n)
+                    data = fh.read(sum(lengths))
+                    values = []
+                    offset = 0
+                    for length in lengths:
+                        values.append(data[offset:offset + length])
+                        offset += length
+                    columns.append(values)
+            counts = _read_array(fh, 'q', n)
+            yield _id, schema, zip(zip(*columns), counts)
+        elif record != END:
+            raise IOError('Corrupt columnar myrial file')
@@ -1,7 +1,23 @@
 
+import checkpoint
+import db
 import myrial
+import parser
+import relation
+import server
+import sinks
+import tracing
 
+import ast
 import collections
+import csv
+import itertools
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 import unittest
 
 """
@@ -36,6 +52,79 @@ WHILE Delta;
 DUMP Reachable;
 '''
 
+invariant_query = '''
+Edge = LOAD "edge.txt" AS (source:int, dest:int);
+Reachable = Edge;
+DO
+  Reversed = FOREACH Edge EMIT (dest, source) AS (source:int, dest:int);
+  _A = JOIN Reachable BY dest, Edge BY source;
+  NewlyReachable = DISTINCT FOREACH _A EMIT (Reachable.source, Edge.dest) AS
+      (source:int, dest:int);
+  Delta = DIFF NewlyReachable, Reachable;
+  Reachable = UNION Delta, Reachable;
+WHILE Delta;
+EXPLAIN NewlyReachable;
+'''
+
+nested_query = '''
+Edge = LOAD "edge.txt" AS (source:int, dest:int);
+Rounds = TABLE [%s] AS (a:int, b:int);
+DO
+  Round = LIMIT Rounds, 1;
+  Rounds = DIFF Rounds, Round;
+  Reachable = Edge;
+  DO
+    Reversed = FOREACH Edge EMIT (dest, source) AS (source:int, dest:int);
+    _A = JOIN Reachable BY dest, Edge BY source;
+    NewlyReachable = DISTINCT FOREACH _A EMIT (Reachable.source, Edge.dest)
+        AS (source:int, dest:int);
+    Delta = DIFF NewlyReachable, Reachable;
+    Reachable = UNION Delta, Reachable;
+  WHILE Delta;
+WHILE Rounds;
+'''
+
+closure_query = '''
+Edge = LOAD "edge.txt" AS (source:int, dest:int);
+Reachable = CLOSURE Edge;
+DUMP Reachable;
+'''
+
+triangle_query = '''
+E1 = TABLE [(1,2),(2,3),(3,1),(3,1),(2,4),(4,1),(4,2),(5,5)]
+  AS (source:int, dest:int);
+E2 = E1;
+E3 = E1;
+A = JOIN E1 BY dest, E2 BY source;
+T = JOIN A BY (E2.dest, E1.source), E3 BY (source, dest);
+EXPLAIN T;
+DUMP T;
+'''
+
+prepared_query = '''
+Emp = LOAD $employees AS (id:int, dept_id:int, name:string, salary:int);
+Dept = TABLE $departments AS (id:int, name:string, manager_id:int);
+A = JOIN Emp BY dept_id, Dept BY id;
+DUMP A;
+'''
+
+approx_query = '''
+Emp = LOAD "employees.txt" AS (id:int, dept_id:int, name:string, salary:int);
+A = SAMPLE Emp, 3;
+B = SAMPLE Emp, 100 %;
+C = LIMIT Emp, 2;
+D = APPROX DISTINCT Emp;
+DUMP A;
+DUMP B;
+DUMP C;
+DUMP D;
+'''
+
+def myrial_output(query, **kwargs):
+  output = []
+  myrial.evaluate(query, out=output, **kwargs)
+  return output
+
 class SystemTests(unittest.TestCase):
 
   def test_employees(self):
@@ -79,6 +168,25 @@ class SystemTests(unittest.TestCase):
   def test_fof_eager(self):
     self.__do_eager_test(fof_query)
 
+  def __do_compiled_test(self, query):
+    '''Validate that compiled and interpreted evaluation agree'''
+    out1 = []
+    myrial.evaluate(query, out=out1, compiled=False)
+
+    out2 = []
+    myrial.evaluate(query, out=out2, compiled=True)
+
+    self.assertEqual(out1, out2)
+
+  def test_employees_compiled(self):
+    self.__do_compiled_test(emp_query)
+
+  def test_fof_compiled(self):
+    self.__do_compiled_test(fof_query)
+
+  def test_transitive_closure_compiled(self):
+    self.__do_compiled_test(tc_query)
+
   def test_transitive_closure(self):
     output = []
     myrial.evaluate(tc_query, out=output)
@@ -88,3 +196,420 @@ class SystemTests(unittest.TestCase):
        (3, 4),(2, 4),(6, 5),(3, 5)])
 
     self.assertEqual(output[0], expected)
+
+  def test_loop_invariant_hoisting(self):
+    out = StringIO.StringIO()
+    processor = myrial.StatementProcessor(out)
+    processor.evaluate(parser.Parser().parse(invariant_query))
+
+    # Edge and Reversed are evaluated once, before the loop
+    hoisted = sorted(key.relation for key in processor.hoisted)
+    self.assertEqual(hoisted, ['Edge.invariant.0', 'Reversed.invariant.0'])
+    self.assertIn('Edge.invariant.0 : loop-invariant', out.getvalue())
+
+    # The initial edges keep their multiplicity; derived pairs appear once
+    with open('edge.txt') as fh:
+      edges = collections.Counter(tuple(int(x) for x in line.split())
+                                  for line in fh
+                                  if line.strip() and not line.startswith('#'))
+    reachable = set(edges)
+    while True:
+      new = set((s, d2) for (s, d1) in reachable for (s2, d2) in edges
+                if d1 == s2) - reachable
+      if not new:
+        break
+      reachable |= new
+    expected = edges + collections.Counter(reachable - set(edges))
+
+    result = processor.db.evaluate_to_bag(processor.symbols['Reachable'])
+    self.assertEqual(result, expected)
+
+  def test_nested_loop_hoisting(self):
+    def run(rounds):
+      rows = ', '.join('(%d, %d)' % (k, k) for k in range(rounds))
+      processor = myrial.StatementProcessor(StringIO.StringIO(),
+                                            native_closure=False)
+      processor.evaluate(parser.Parser().parse(nested_query % rows))
+      stored = sorted(key.relation
+                      for key in processor.db.relations().keys()
+                      if key.program == processor.program_name)
+      return processor, stored
+
+    # Re-entering the inner loop replaces the relations it hoisted
+    few, few_stored = run(2)
+    many, many_stored = run(4)
+    self.assertEqual(few_stored, many_stored)
+    self.assertEqual(len(few.hoisted), len(many.hoisted))
+    self.assertEqual(len(few.plans), len(many.plans))
+    self.assertIn('Reversed.invariant.1', many_stored)
+
+  def __run(self, query, **kwargs):
+    output = []
+    processor = myrial.StatementProcessor(output, **kwargs)
+    processor.evaluate(parser.Parser().parse(query))
+    return output, processor
+
+  def test_native_closure(self):
+    with open('reachable.myl') as fh:
+      query = fh.read()
+
+    native, processor = self.__run(query)
+    self.assertEqual(processor.symbols['Reachable'].kwargs['relation_key'],
+                     processor.plans.keys()[0])
+    self.assertEqual(processor.plans.values()[0].type, 'CLOSURE')
+
+    generic, processor = self.__run(query, native_closure=False)
+    self.assertEqual(native, generic)
+
+    # The loop temporaries hold their values at the fixpoint
+    for _id in ['_A', 'NewlyReachable', 'Delta']:
+      self.assertEqual(self.__run(query + 'DUMP %s;' % _id)[0],
+                       self.__run(query + 'DUMP %s;' % _id,
+                                  native_closure=False)[0])
+
+  def test_explicit_closure(self):
+    with open('reachable.myl') as fh:
+      expected, _ = self.__run(fh.read(), native_closure=False)
+    actual, _ = self.__run(closure_query)
+    self.assertEqual(actual, expected)
+
+  def test_triangles(self):
+    output = []
+    myrial.evaluate(triangle_query, out=output)
+    self.assertEqual(output[0].type, 'MULTIJOIN')
+    self.assertEqual(len(output[0].children), 3)
+
+    edges = output[0].children[0].kwargs['tuple_list']
+    expected = collections.Counter([a + b + c for a in edges for b in edges
+                                    for c in edges if a[1] == b[0] and
+                                    b[1] == c[0] and c[1] == a[0]])
+    self.assertTrue(expected)
+    self.assertEqual(output[1], expected)
+
+  def test_triangles_eager(self):
+    self.__do_eager_test(triangle_query.replace('EXPLAIN T;', ''))
+
+  def test_server(self):
+    def parse_dump(lines):
+      bags = []
+      for line in lines:
+        _id, tuples = line.split(' : ', 1)
+        bags.append(collections.Counter(ast.literal_eval(tuples)))
+      return bags
+
+    tmpdir = tempfile.mkdtemp()
+    address = os.path.join(tmpdir, 'myrial.sock')
+    catalog = '''Emp = LOAD "employees.txt" AS (id:int, dept_id:int,
+                   name:string, salary:int);
+                   Dept = LOAD "departments.txt" AS (id:int, name:string,
+                   manager_id:int);'''
+    s = server.make_server(address, catalog, workers=2)
+    t = threading.Thread(target=s.serve_forever)
+    t.start()
+    try:
+      # Programs see the relations defined by the catalog
+      queries = [emp_query, fof_query, tc_query,
+                 'A = JOIN Emp BY dept_id, Dept BY id; DUMP A;']
+      results = [None] * len(queries)
+      def run(i):
+        results[i] = list(server.submit(address, queries[i]))
+      clients = [threading.Thread(target=run, args=(i,))
+                 for i in range(len(queries))]
+      for c in clients:
+        c.start()
+      for c in clients:
+        c.join()
+
+      for query, lines in zip(queries[:3], results):
+        output = []
+        myrial.evaluate(query, out=output)
+        self.assertEqual(parse_dump(lines), output)
+      self.assertEqual(parse_dump(results[3]), parse_dump(results[0]))
+
+      lines = list(server.submit(address, 'DUMP Nothing;'))
+      self.assertTrue(lines[0].startswith('ERROR: '))
+
+      # Programs do not leave relations behind
+      keys = set(key.program for key in s.database.db)
+      self.assertTrue(len(keys) <= 1)
+    finally:
+      s.shutdown()
+      s.server_close()
+      t.join()
+      shutil.rmtree(tmpdir)
+
+  def test_server_memory_budget(self):
+    tmpdir = tempfile.mkdtemp()
+    address = os.path.join(tmpdir, 'myrial.sock')
+    s = server.make_server(address, memory_capacity=4 * 10**6,
+                           program_budget=2 * 10**6, admission_timeout=10)
+    t = threading.Thread(target=s.serve_forever)
+    t.start()
+    try:
+      lines = list(server.submit(address, emp_query))
+      self.assertTrue(lines[0].startswith('A : '))
+
+      # A join whose result is too large fails with a clear error
+      rows = ','.join('(%d,1)' % k for k in range(300))
+      query = '''T = TABLE[%s] AS (a:int, b:int);
+                 U = TABLE[%s] AS (c:int, d:int);
+                 A = JOIN T BY b, U BY d;
+                 B = DISTINCT A;
+                 DUMP B;''' % (rows, rows)
+      lines = list(server.submit(address, query))
+      self.assertEqual(len(lines), 1)
+      self.assertTrue(lines[0].startswith('ERROR: PROGRAM-'))
+      self.assertTrue('budget of 2000000 bytes' in lines[0])
+
+      # Programs release their reservations when they finish
+      self.assertEqual(s.admission.reserved, 0)
+    finally:
+      s.shutdown()
+      s.server_close()
+      t.join()
+      shutil.rmtree(tmpdir)
+
+  def test_prepared_program(self):
+    program = myrial.prepare(prepared_query)
+    self.assertEqual(program.parameters, set(['employees', 'departments']))
+
+    departments = [(1, 'accounting', 5), (2, 'human resources', 2),
+                   (3, 'engineering', 2)]
+    for k in range(1, 4):
+      output = []
+      program.execute({'employees' : 'employees.txt',
+                       'departments' : departments[:k]}, out=output)
+      expected = collections.Counter(
+        [t for t in myrial_output(emp_query)[0] if t[1] <= k])
+      self.assertEqual(output[0], expected)
+
+    self.assertRaises(myrial.UnboundParameterException, program.execute,
+                      {'employees' : 'employees.txt'}, [])
+    self.assertRaises(relation.TupleTypeException, program.execute,
+                      {'employees' : 'employees.txt',
+                       'departments' : [(1, 2)]}, [])
+
+    # Only prepared programs may leave parameters unbound
+    self.assertRaises(myrial.UnboundParameterException, myrial.evaluate,
+                      'X = LOAD $p AS (a:int); DUMP X;', [])
+
+  def test_prepared_loop(self):
+    program = myrial.prepare(tc_query.replace(
+      'TABLE[(1,2),(2,3),(3,4),(3,5),(6,5),(7,2)]', 'TABLE $edges'))
+    output = []
+    program.execute({'edges' : [(1,2),(2,3),(3,4),(3,5),(6,5),(7,2)]},
+                    out=output)
+    self.assertEqual(output, myrial_output(tc_query))
+
+  def test_sinks(self):
+    expected = myrial_output(emp_query)[0]
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # Tab-delimited output can be loaded again
+      path = os.path.join(tmpdir, 'emp.txt')
+      with open(path, 'w') as fh:
+        myrial.evaluate(emp_query, sink=sinks.TabDelimitedSink(fh, 2))
+      query = '''A = LOAD "%s" AS (id:int, dept_id:int, name:string,
+        salary:int, id2:int, dept_name:string, manager_id:int);
+        DUMP A;''' % path
+      self.assertEqual(myrial_output(query)[0], expected)
+
+      with open(path, 'w') as fh:
+        myrial.evaluate(emp_query, sink=sinks.CsvSink(fh, 3))
+      with open(path) as fh:
+        rows = list(csv.reader(fh))
+      self.assertEqual(rows[0][:2], ['Emp.id', 'Emp.dept_id'])
+      self.assertEqual(collections.Counter(tuple(r) for r in rows[1:]),
+                       collections.Counter(tuple(str(x) for x in t)
+                                           for t in expected.elements()))
+
+      with open(path, 'wb') as fh:
+        myrial.evaluate(emp_query, sink=sinks.ColumnarSink(fh, 3))
+      with open(path, 'rb') as fh:
+        chunks = list(sinks.read_columnar(fh))
+      self.assertEqual([len(pairs) for _, _, pairs in chunks], [3, 3, 1])
+      self.assertEqual(str(chunks[0][1]), str(myrial_output(
+        emp_query.replace('DUMP A', 'DESCRIBE A'))[0]))
+      self.assertEqual(db.to_bag(itertools.chain.from_iterable(
+        pairs for _, _, pairs in chunks)), expected)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_iterator_sink(self):
+    sink = sinks.IteratorSink(chunk_size=2, max_chunks=1)
+    def produce():
+      try:
+        myrial.evaluate(fof_query, sink=sink)
+      finally:
+        sink.close()
+    t = threading.Thread(target=produce)
+    t.start()
+    actual = collections.Counter()
+    for _id, tpl, count in sink:
+      self.assertEqual(_id, 'FoF')
+      actual[tpl] += count
+    t.join()
+    self.assertEqual(actual, myrial_output(fof_query)[0])
+
+  def test_chunked_dump(self):
+    out = StringIO.StringIO()
+    chunk_size = sinks.DEFAULT_CHUNK_SIZE
+    sinks.DEFAULT_CHUNK_SIZE = 3
+    try:
+      myrial.evaluate(fof_query, out=out)
+    finally:
+      sinks.DEFAULT_CHUNK_SIZE = chunk_size
+    _id, tuples = out.getvalue().split(' : ')
+    self.assertEqual(_id, 'FoF')
+    self.assertTrue(tuples.endswith(']\n'))
+    self.assertEqual(collections.Counter(ast.literal_eval(tuples)),
+                     myrial_output(fof_query)[0])
+
+  def test_checkpoint_resume(self):
+    expected = myrial_output(tc_query)
+    statements = parser.Parser().parse(tc_query)
+
+    class Crash(Exception):
+      pass
+
+    class CrashingProcessor(myrial.StatementProcessor):
+      def save_checkpoint(self, path, fingerprint, symbols, iteration, done):
+        myrial.StatementProcessor.save_checkpoint(
+          self, path, fingerprint, symbols, iteration, done)
+        if iteration == 1:
+          raise Crash()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+      output = []
+      processor = CrashingProcessor(output, native_closure=False,
+                                    checkpoint_dir=tmpdir,
+                                    checkpoint_interval=1)
+      self.assertRaises(Crash, processor.evaluate, statements)
+      self.assertEqual(output, [])
+      self.assertEqual(processor.iteration, None)
+
+      # The resumed loop starts from the first iteration's checkpoint
+      path = os.path.join(tmpdir, 'loop-0.ckpt')
+      saved = checkpoint.read_checkpoint(path)
+      self.assertEqual(saved.iteration, 1)
+      self.assertFalse(saved.done)
+
+      output, processor = self.__run(tc_query, native_closure=False,
+                                     checkpoint_dir=tmpdir, resume=True)
+      self.assertEqual(output, expected)
+      self.assertTrue(
+        any(key.relation.startswith('Reachable.checkpoint.1')
+            for key in processor.db.db))
+      saved = checkpoint.read_checkpoint(path)
+      self.assertTrue(saved.done)
+
+      # A finished loop is restored rather than run again
+      output, processor = self.__run(tc_query, native_closure=False,
+                                     checkpoint_dir=tmpdir, resume=True)
+      self.assertEqual(output, expected)
+      self.assertEqual(processor.plans, {})
+
+      # The checkpoint is not resumed on different edges
+      changed = tc_query.replace('(1,2),(2,3),(3,4),(3,5),(6,5),(7,2)',
+                                 '(7,8),(8,9)')
+      self.assertRaises(checkpoint.CheckpointException, self.__run, changed,
+                        native_closure=False, checkpoint_dir=tmpdir,
+                        resume=True)
+
+      # Restored relations must have the schemas the program expects
+      saved = checkpoint.read_checkpoint(path)
+      other = relation.Schema.from_strings(['a:int', 'b:int'])
+      saved.relations = [(_id, other, compressed)
+                         for _id, schema, compressed in saved.relations]
+      self.assertRaises(checkpoint.CheckpointException,
+                        processor.restore_checkpoint, saved, saved.fingerprint)
+
+      # Loops run as native closures are not checkpointed, so their inputs
+      # are not read for a fingerprint
+      class NativeProcessor(myrial.StatementProcessor):
+        def loop_fingerprint(self, statement_list, termination_ex):
+          raise Crash()
+      output = []
+      NativeProcessor(output, checkpoint_dir=tmpdir).evaluate(statements)
+      self.assertEqual(output, expected)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_adaptive_loop(self):
+    with open('reachable.myl') as fh:
+      query = fh.read()
+
+    log = StringIO.StringIO()
+    adaptive, processor = self.__run(query, native_closure=False,
+                                     plan_log=log)
+    fixed, _ = self.__run(query, native_closure=False, adaptive=False)
+    self.assertEqual(adaptive, fixed)
+
+    # Sizes are recorded after every iteration; the last Delta is empty
+    iterations = [i for i, _ in processor.cardinalities]
+    self.assertEqual(iterations, range(1, len(iterations) + 1))
+    self.assertEqual(processor.cardinalities[-1][1]['Delta'], 0)
+    growth = [sizes['Reachable'] for _, sizes in processor.cardinalities]
+    self.assertEqual(growth, sorted(growth))
+
+    lines = log.getvalue().splitlines()
+    self.assertTrue(any(line.startswith('iteration 2: _A = JOIN: ')
+                        for line in lines))
+    self.assertTrue(any('Delta=0' in line for line in lines))
+
+  def test_approximate_queries(self):
+    emp = myrial_output('''Emp = LOAD "employees.txt" AS (id:int,
+      dept_id:int, name:string, salary:int); DUMP Emp;''')[0]
+    sample, everything, limited, distinct = myrial_output(approx_query)
+
+    self.assertEqual(sum(sample.values()), 3)
+    self.assertTrue(set(sample) <= set(emp))
+    self.assertEqual(everything, emp)
+    self.assertEqual(sum(limited.values()), 2)
+
+    [(estimate, low, high)] = distinct.keys()
+    self.assertEqual(estimate, len(emp))
+    self.assertTrue(low <= len(emp) <= high)
+
+  def test_tracing(self):
+    log = StringIO.StringIO()
+    latencies = tracing.LatencyHistogramSink()
+    tracer = tracing.Tracer([tracing.JsonLogSink(log), latencies])
+    output, _ = self.__run(tc_query, native_closure=False, tracer=tracer)
+    self.assertEqual(output, myrial_output(tc_query))
+
+    events = [json.loads(line) for line in log.getvalue().splitlines()]
+    self.assertEqual(events[0]['event'], 'statement_start')
+    self.assertEqual(events[0]['symbol'], 'Edge')
+    self.assertEqual(events[-1]['event'], 'statement_end')
+    self.assertEqual(events[-1]['statement'], 'DUMP')
+
+    iterations = [e['iteration'] for e in events
+                  if e['event'] == 'loop_iteration']
+    self.assertEqual(iterations, range(1, len(iterations) + 1))
+    sizes = [e for e in events if e['event'] == 'loop_iteration'][-1]['sizes']
+    self.assertEqual((sizes['Delta'], sizes['Reachable']), (0, 14))
+    materialized = [e for e in events if e['event'] == 'materialize']
+    self.assertTrue(all(e['bytes'] > 0 for e in materialized
+                        if e['rows'] > 0))
+
+    self.assertEqual(latencies.count('statement DUMP'), 1)
+    self.assertEqual(latencies.count('loop iteration'), len(iterations))
+    self.assertTrue('operator JOIN: count=%d' % len(iterations)
+                    in latencies.summary())
+
+    # Failed statements are reported
+    log.truncate(0)
+    self.assertRaises(KeyError, myrial.evaluate, 'DUMP Nothing;', out=[],
+                      tracer=tracer)
+    event = json.loads(log.getvalue().splitlines()[-1])
+    self.assertEqual(event['error'], "KeyError: 'Nothing'")
+
+  def test_compressed(self):
+    with open('reachable.myl') as fh:
+      query = fh.read()
+    self.assertEqual(myrial_output(query, compressed=True),
+                     myrial_output(query))
+    self.assertEqual(myrial_output(tc_query, compressed=True),
+                     myrial_output(tc_query))
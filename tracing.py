@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+'''Structured trace events for programs and operators
+
+A Tracer passed to a StatementProcessor receives an event for each step of
+the program's execution, and forwards it to its sinks.  Events are dicts
+with an 'event' name, a 'time' and these fields:
+
+  statement_start  statement, symbol
+  statement_end    statement, symbol, seconds, error
+  operator_open    operator, span
+  operator_close   operator, span, rows, tuples, seconds
+  materialize      relation, rows, bytes
+  loop_iteration   iteration, seconds, sizes
+
+Operators are traced from the call that evaluates them until their output
+has been read, so their times include the time spent reading their inputs.
+rows counts (tuple, multiplicity) pairs and tuples sums the multiplicities.
+
+Tracing is disabled by default; untraced programs only pay for a check of
+the tracer at each statement and operator.
+'''
+
+import itertools
+import json
+import math
+import threading
+import time
+
+class Tracer:
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.spans = itertools.count()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        for sink in self.sinks:
+            sink.record(fields)
+
+    def trace_operator(self, expr, evaluate):
+        '''Return evaluate(expr), emitting events as its output is read'''
+        span = next(self.spans)
+        self.emit('operator_open', operator=expr.type, span=span)
+        start = time.time()
+        result = evaluate(expr)
+        if result is None:
+            self.emit('operator_close', operator=expr.type, span=span,
+                      rows=0, tuples=0, seconds=time.time() - start)
+            return None
+        return self.__count(result, expr.type, span, start)
+
+    def __count(self, pairs, operator, span, start):
+        rows = 0
+        tuples = 0
+        try:
+            for tpl, count in pairs:
+                rows += 1
+                tuples += count
+                yield tpl, count
+        finally:
+            self.emit('operator_close', operator=operator, span=span,
+                      rows=rows, tuples=tuples, seconds=time.time() - start)
+
+class TraceSink:
+    def record(self, event):
+        raise NotImplementedError()
+
+class JsonLogSink(TraceSink):
+    '''Write each event as a line of JSON'''
+    def __init__(self, fh):
+        self.fh = fh
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        line = json.dumps(event, sort_keys=True, default=str) + '\n'
+        with self.lock:
+            self.fh.write(line)
+
+class LatencyHistogramSink(TraceSink):
+    '''Collect histograms of the latencies of statements and operators
+
+    Latencies are counted in buckets whose bounds are powers of two
+    microseconds.  Histograms are named by kind and type, such as
+    'statement DUMP', 'operator JOIN' or 'loop iteration'.
+    '''
+    def __init__(self):
+        # Map from name to a list of counts per bucket
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def name(event):
+        if event['event'] == 'statement_end':
+            return 'statement %s' % event['statement']
+        elif event['event'] == 'operator_close':
+            return 'operator %s' % event['operator']
+        elif event['event'] == 'loop_iteration':
+            return 'loop iteration'
+        return None
+
+    @staticmethod
+    def bucket(seconds):
+        '''Return the histogram bucket of a latency
+
+        Bucket 0 holds latencies under 1us, and bucket k those under 2**k us.
+        '''
+        micros = seconds * 1e6
+        if micros < 1:
+            return 0
+        return int(math.floor(math.log(micros, 2))) + 1
+
+    def record(self, event):
+        name = LatencyHistogramSink.name(event)
+        if name is None:
+            return
+        bucket = LatencyHistogramSink.bucket(event['seconds'])
+        with self.lock:
+            counts = self.histograms.setdefault(name, [])
+            if len(counts) <= bucket:
+                counts.extend([0] * (bucket + 1 - len(counts)))
+            counts[bucket] += 1
+
+    def count(self, name):
+        return sum(self.histograms.get(name, []))
+
+    def percentile(self, name, q):
+        '''Return an upper bound, in seconds, on the q'th percentile'''
+        counts = self.histograms[name]
+        rank = q / 100.0 * sum(counts)
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return 2 ** bucket / 1e6
+        return 2 ** (len(counts) - 1) / 1e6
+
+    def summary(self):
+        '''Return a line per histogram with its count and percentiles'''
+        lines = []
+        for name in sorted(self.histograms):
+            lines.append('%s: count=%d p50<=%gs p90<=%gs p99<=%gs' % (
+                name, self.count(name), self.percentile(name, 50),
+                self.percentile(name, 90), self.percentile(name, 99)))
+        return '\n'.join(lines)